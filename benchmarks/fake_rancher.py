@@ -0,0 +1,542 @@
+#!/usr/bin/env python
+"""A local stand-in for the parts of the Rancher v1 and v2-beta APIs that rancher-gitlab-deploy uses
+
+It serves environments with stacks, services, their containers and secrets, supports the name and
+id filters and the pagination of collections, and runs the upgrade, finishupgrade and rollback
+actions through the same states as Rancher, taking --delay seconds for each transition. Every request
+is counted per API access key, so the requests and bytes of each deploy can be told apart.
+
+    python benchmarks/fake_rancher.py --port 8080 --services 10000 --delay 1 --latency 0.02
+
+Images with "crash" in their name start containers that end up in error, to try out rollbacks. The
+/probe/<service> endpoint answers with a 500 while containers of the service run an image with
+"unhealthy" in its name, to try out --canary-probe-url, and upgrades to images with "stuck" in their name
+can't be continued once paused. Containers are spread over --hosts hosts, and a
+host takes --pull-delay seconds to pull an image it doesn't have yet, during the upgrade or in a pull
+task (images with "missing" in their name fail to pull), to try out --pre-pull. Metrics pushed to /metrics/job/<job>/... are
+kept by group like a Prometheus Pushgateway, and served back on /metrics, to try out --metrics-push-url.
+The state changes of the services are sent as resource.change events to the websockets subscribed on
+/v1/projects/<id>/subscribe, to try out --events, and --drop-events closes them after that many seconds.
+With --batch-delay, upgrades honour the batchSize and intervalMillis they're sent, each batch taking that
+many seconds, to try out --rollout-time.
+"""
+
+import argparse
+import base64
+import hashlib
+import itertools
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qsl
+from urllib.parse import urlencode
+from urllib.parse import urlsplit
+
+# Rancher's default and maximum page sizes
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+# appended to the key of a websocket handshake to accept it (RFC 6455)
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class FakeRancher(object):
+    """The state of the fake Rancher server, and the HTTP server serving it"""
+
+    def __init__(
+        self,
+        services=6,
+        stacks=1,
+        scale=2,
+        delay=0.5,
+        latency=0.0,
+        secrets=("db-pass", "api-key"),
+        environments=1,
+        hosts=3,
+        pull_delay=0.0,
+        batch_delay=0.0,
+        drop_events=None,
+    ):
+        self.delay = delay
+        self.latency = latency
+        self.scale = scale
+        self.pull_delay = pull_delay
+        self.batch_delay = batch_delay
+        self.drop_events = drop_events
+        # the (environment id, handler) of each websocket subscribed to the events
+        self.subscribers = []
+        self.hosts = ["1h%d" % number for number in range(1, hosts + 1)]
+        # the images each host has pulled
+        self.host_images = dict((host, set()) for host in self.hosts)
+        self.pull_tasks = {}
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        # the index of the next container to replace, and the inServiceStrategy, of each service being upgraded
+        self.progress = {}
+        self.strategies = {}
+        self.server = None
+        self.url = None
+
+        self.projects = [{"id": "1a5", "name": "Default", "type": "project"}]
+        self.projects += [{"id": "1a%d" % (5 + n), "name": "env%d" % n, "type": "project"} for n in range(1, environments)]
+        self.stacks = []
+        self.services = {}
+        self.instances = {}
+        self.secrets = [{"id": "1se%d" % next(self.ids), "name": name, "type": "secret"} for name in secrets]
+        self.stats = {}
+        # the last metrics pushed to each group, by the path they were pushed to
+        self.pushed = {}
+
+        # every environment has the same stacks and services, like staging and production would
+        for project in self.projects:
+            project_stacks = [self.add_stack("stack%d" % number, project["id"]) for number in range(stacks)]
+
+            for number in range(services):
+                # a third of the services are built from a shared base image, half of them are labelled tier=web
+                image = "registry.example.com/base:1" if number % 3 == 0 else "registry.example.com/app:1"
+                labels = {"tier": "web" if number % 2 == 0 else "worker"}
+                stack_id = project_stacks[number % stacks]["id"]
+                self.add_service(stack_id, "svc%d" % number, image, launch_config={"labels": labels})
+
+    def add_stack(self, name, project_id="1a5"):
+        with self.lock:
+            stack = {"id": "1st%d" % next(self.ids), "name": name, "accountId": project_id, "type": "stack"}
+            self.stacks.append(stack)
+            return stack
+
+    def add_service(self, stack_id, name, image, scale=None, launch_config=None):
+        with self.lock:
+            service_id = "1s%d" % next(self.ids)
+            launch_config = dict(launch_config or {}, imageUuid="docker:%s" % image)
+            launch_config.setdefault("labels", {})
+            launch_config.setdefault("environment", {})
+            stack = [stack for stack in self.stacks if stack["id"] == stack_id][0]
+
+            service = {
+                "id": service_id,
+                "name": name,
+                "stackId": stack_id,
+                "accountId": stack["accountId"],
+                "state": "active",
+                "scale": self.scale if scale is None else scale,
+                "launchConfig": launch_config,
+                "secondaryLaunchConfigs": [],
+                "type": "service",
+                "actions": {},
+            }
+            self.services[service_id] = service
+            self.instances[service_id] = [self.new_instance(service) for _ in range(service["scale"])]
+            return service
+
+    def new_instance(self, service, host=None):
+        number = next(self.ids)
+        crashed = "crash" in service["launchConfig"]["imageUuid"]
+        host = host or self.hosts[number % len(self.hosts)]
+        self.host_images[host].add(service["launchConfig"]["imageUuid"])
+        return {
+            "id": "1i%d" % number,
+            "name": "%s-%d" % (service["name"], number),
+            "state": "error" if crashed else "running",
+            "healthState": None if crashed else "healthy",
+            "startCount": 1,
+            "imageUuid": service["launchConfig"]["imageUuid"],
+            "hostId": host,
+            "transitioningMessage": "Exited (1)" if crashed else None,
+            "type": "container",
+        }
+
+    def start(self, host="127.0.0.1", port=0):
+        """Starts serving in a background thread, returns the URL to pass as --rancher-url"""
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.url = "http://%s:%d" % self.server.server_address[:2]
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, key, bytes_received, bytes_sent):
+        with self.lock:
+            stats = self.stats.setdefault(key, {"requests": 0, "bytes_received": 0, "bytes_sent": 0})
+            stats["requests"] += 1
+            stats["bytes_received"] += bytes_received
+            stats["bytes_sent"] += bytes_sent
+
+    def later(self, delay, function, *args):
+        timer = threading.Timer(delay, self.locked, (function,) + args)
+        timer.daemon = True
+        timer.start()
+
+    def locked(self, function, *args):
+        with self.lock:
+            function(*args)
+
+    def collection(self, url, resources, query):
+        """Filters resources by the query fields, and returns the page asked for by limit and marker"""
+        limit = min(int(query.pop("limit", DEFAULT_LIMIT)), MAX_LIMIT)
+        marker = int(query.pop("marker", 0) or 0)
+        matching = [r for r in resources if all(str(r.get(key)) == value for key, value in query.items())]
+
+        next_url = None
+        if marker + limit < len(matching):
+            next_url = "%s?%s" % (url, urlencode(dict(query, limit=limit, marker=marker + limit)))
+
+        return 200, {
+            "type": "collection",
+            "data": matching[marker : marker + limit],
+            "pagination": {"limit": limit, "marker": marker, "next": next_url},
+        }
+
+    def route(self, method, path, query, body):
+        """Returns the status and the JSON document answering a request"""
+        url = self.url + path
+        parts = [part for part in path.split("/") if part]
+
+        if len(parts) == 2 and parts[0] == "probe":
+            services = [service["id"] for service in self.services.values() if service["name"] == parts[1]]
+            instances = [i for service_id in services for i in self.instances[service_id] if i["state"] == "running"]
+            healthy = not any("unhealthy" in instance["imageUuid"] for instance in instances)
+            return (200 if healthy else 500), {"healthy": healthy}
+
+        if parts and parts[0] == "metrics":
+            if method in ("POST", "PUT") and len(parts) >= 3 and parts[1] == "job":
+                self.pushed[path] = body
+                return 200, {}
+            return 200, "".join(self.pushed.values())
+
+        if len(parts) < 2 or parts[0] not in ("v1", "v2-beta") or parts[1] != "projects":
+            return 404, {"type": "error", "status": 404}
+
+        if len(parts) == 2:
+            return self.collection(url, self.projects, query)
+
+        project = parts[2]
+        if project not in [known["id"] for known in self.projects]:
+            return 404, {"type": "error", "status": 404}
+
+        rest = parts[3:]
+
+        if rest == ["environments"]:
+            if method == "POST":
+                return 201, self.add_stack(body["name"], project)
+            return self.collection(url, self.stacks, dict(query, accountId=project))
+
+        if len(rest) == 3 and rest[0] == "environments" and rest[2] == "services":
+            return self.collection(url, self.services.values(), dict(query, stackId=rest[1]))
+
+        if rest == ["services"]:
+            if method == "POST":
+                return 201, self.create_service(body)
+            return self.collection(url, self.services.values(), dict(query, accountId=project))
+
+        if rest == ["pulltasks"] and method == "POST":
+            return 201, self.pull(body["image"], body.get("mode", "all"))
+
+        if len(rest) == 2 and rest[0] == "pulltasks" and rest[1] in self.pull_tasks:
+            return 200, self.pull_tasks[rest[1]]
+
+        if rest == ["secrets"]:
+            return self.collection(url, self.secrets, query)
+
+        if len(rest) >= 2 and rest[0] == "services":
+            service = self.services.get(rest[1])
+            if service is None:
+                return 404, {"type": "error", "status": 404}
+
+            if len(rest) == 3 and rest[2] == "instances":
+                return self.collection(url, self.instances[service["id"]], query)
+
+            if len(rest) == 2 and method == "POST":
+                return self.action(service, query.get("action"), body or {})
+
+            if len(rest) == 2 and method == "PUT":
+                service["metadata"] = (body or {}).get("metadata", service.get("metadata"))
+                return 200, service
+
+            if len(rest) == 2:
+                return 200, service
+
+        return 404, {"type": "error", "status": 404}
+
+    def create_service(self, body):
+        service = self.add_service(
+            body["stackId"], body["name"], body["launchConfig"]["imageUuid"][len("docker:") :], 1, body["launchConfig"]
+        )
+        service["actions"] = {
+            "setservicelinks": "%s/v2-beta/projects/%s/services/%s/?action=setservicelinks"
+            % (self.url, service["accountId"], service["id"])
+        }
+        return service
+
+    def action(self, service, action, body):
+        state = service["state"]
+
+        if action == "upgrade" and state == "active":
+            strategy = body["inServiceStrategy"]
+            self.strategies[service["id"]] = strategy
+            service["previousLaunchConfig"] = service["launchConfig"]
+            service["launchConfig"] = strategy["launchConfig"]
+            if strategy.get("secondaryLaunchConfigs"):
+                service["secondaryLaunchConfigs"] = strategy["secondaryLaunchConfigs"]
+            self.transition(service, "upgrading")
+            self.replace_instances(service, 0)
+        elif action == "finishupgrade" and state == "upgraded":
+            self.transition(service, "finishing-upgrade")
+            self.later(self.delay, self.transition, service, "active")
+        elif action == "cancelupgrade" and state == "upgrading":
+            self.transition(service, "canceling-upgrade")
+            self.later(self.delay / 2, self.transition, service, "canceled-upgrade")
+        elif action == "continueupgrade" and "stuck" in service["launchConfig"]["imageUuid"]:
+            return 500, {"type": "error", "status": 500, "code": "ServerError", "message": "Unable to continue the upgrade"}
+        elif action == "continueupgrade" and state == "canceled-upgrade":
+            self.transition(service, "upgrading")
+            self.replace_instances(service, self.progress[service["id"]])
+        elif action == "rollback" and state in ("upgrading", "upgraded", "canceled-upgrade"):
+            service["launchConfig"] = service.pop("previousLaunchConfig", service["launchConfig"])
+            self.transition(service, "rolling-back")
+            self.instances[service["id"]] = [self.new_instance(service) for _ in range(service["scale"])]
+            self.later(self.delay, self.transition, service, "active")
+        elif action == "setservicelinks":
+            service["serviceLinks"] = body.get("serviceLinks") or []
+        else:
+            return 422, {"type": "error", "status": 422, "code": "InvalidState", "message": "%s in %s" % (action, state)}
+
+        return 202, service
+
+    def pull(self, image, mode):
+        """Starts a pull task, pulling the image on all the hosts or on the ones with another tag of it"""
+        repository = image.rpartition(":")[0] or image
+        hosts = [
+            host
+            for host, images in self.host_images.items()
+            if mode == "all" or any(known[len("docker:") :].rpartition(":")[0] == repository for known in images)
+        ]
+
+        task = {"id": "1pt%d" % next(self.ids), "type": "pullTask", "image": image, "mode": mode, "state": "activating"}
+        task["status"] = dict((host, "Pulling") for host in hosts)
+        self.pull_tasks[task["id"]] = task
+        self.later(self.pull_delay, self.pulled, task)
+        return task
+
+    def pulled(self, task):
+        for host in task["status"]:
+            if "missing" in task["image"]:
+                task["status"][host] = "Error: manifest for %s not found" % task["image"]
+            else:
+                task["status"][host] = "Done"
+                self.host_images[host].add("docker:%s" % task["image"])
+        task["state"] = "active"
+
+    def transition(self, service, state):
+        service["state"] = state
+        self.publish(service)
+
+    def publish(self, service):
+        """Sends the resource.change event of the service to the websockets subscribed to its environment"""
+        event = {
+            "name": "resource.change",
+            "resourceType": "service",
+            "resourceId": service["id"],
+            "data": {"resource": service},
+        }
+        for project, handler in list(self.subscribers):
+            if project != service["accountId"]:
+                continue
+            try:
+                handler.send_text(json.dumps(event))
+            except OSError:
+                self.subscribers.remove((project, handler))
+
+    def replace_instances(self, service, index):
+        """Replaces the containers one at a time, spreading --delay over them, then marks the service upgraded"""
+        self.progress[service["id"]] = index
+        if service["state"] != "upgrading":
+            return  # paused or rolled back in the meantime
+
+        instances = self.instances[service["id"]]
+        if index == len(instances):
+            self.transition(service, "upgraded")
+            return
+
+        host = instances[index]["hostId"]
+        if self.pull_delay and service["launchConfig"]["imageUuid"] not in self.host_images[host]:
+            # the host pulls the image first, the rest of the upgrade waits for it
+            self.host_images[host].add(service["launchConfig"]["imageUuid"])
+            self.later(self.pull_delay, self.replace_instances, service, index)
+            return
+
+        instance = self.new_instance(service, host)
+        instances[index] = instance
+        if instance["state"] == "error":
+            return  # like Rancher, keep retrying (here: waiting) until the upgrade is rolled back
+
+        if not self.batch_delay:
+            self.later(self.delay / max(len(instances), 1), self.replace_instances, service, index + 1)
+            return
+
+        # with --batch-delay, the containers of a batch take that long to start, then the next batch waits for the interval
+        strategy = self.strategies[service["id"]]
+        if (index + 1) % strategy["batchSize"] and index + 1 < len(instances):
+            self.replace_instances(service, index + 1)
+        else:
+            interval = strategy["intervalMillis"] / 1000.0 if index + 1 < len(instances) else 0
+            self.later(self.batch_delay + interval, self.replace_instances, service, index + 1)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if (self.headers.get("Upgrade") or "").lower() == "websocket":
+            return self.subscribe()
+        self.respond("GET")
+
+    def do_POST(self):
+        self.respond("POST")
+
+    def do_PUT(self):
+        self.respond("PUT")
+
+    def respond(self, method):
+        fake = self.server.fake
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        # pushed metrics are in the Prometheus text format, the rest is JSON
+        text = (self.headers.get("Content-Type") or "").startswith("text/plain")
+        if body:
+            body_document = body.decode("utf-8") if text else json.loads(body)
+        else:
+            body_document = None
+
+        url = urlsplit(self.path)
+        with fake.lock:
+            status, document = fake.route(method, url.path, dict(parse_qsl(url.query)), body_document)
+
+        if isinstance(document, str):
+            data, content_type = document.encode("utf-8"), "text/plain; version=0.0.4"
+        else:
+            data, content_type = json.dumps(document).encode("utf-8"), "application/json"
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+        fake.count(self.access_key(), len(body), len(data))
+
+    def subscribe(self):
+        """Accepts a websocket on /v1/projects/<id>/subscribe and sends it the state changes of the services
+
+        With --drop-events, the connection is closed after that many seconds, like a proxy timing it out.
+        """
+        fake = self.server.fake
+        parts = [part for part in urlsplit(self.path).path.split("/") if part]
+        if len(parts) != 4 or parts[3] != "subscribe":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        accept = hashlib.sha1((self.headers["Sec-WebSocket-Key"] + WEBSOCKET_GUID).encode("ascii")).digest()
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", base64.b64encode(accept).decode("ascii"))
+        self.end_headers()
+        self.wfile.flush()
+
+        with fake.lock:
+            fake.subscribers.append((parts[2], self))
+
+        # the frames the client sends (pings, close) are read and ignored until it goes away
+        self.connection.settimeout(fake.drop_events)
+        try:
+            while self.rfile.read(1):
+                pass
+        except (socket.timeout, OSError):
+            pass
+        finally:
+            with fake.lock:
+                if (parts[2], self) in fake.subscribers:
+                    fake.subscribers.remove((parts[2], self))
+            self.close_connection = True
+
+    def send_text(self, text):
+        """Sends a websocket text frame, unmasked as a server sends them"""
+        data = text.encode("utf-8")
+        if len(data) < 126:
+            header = bytes([0x81, len(data)])
+        elif len(data) < 65536:
+            header = bytes([0x81, 126]) + len(data).to_bytes(2, "big")
+        else:
+            header = bytes([0x81, 127]) + len(data).to_bytes(8, "big")
+        self.wfile.write(header + data)
+        self.wfile.flush()
+
+    def access_key(self):
+        authorization = self.headers.get("Authorization") or ""
+        if not authorization.startswith("Basic "):
+            return ""
+        return base64.b64decode(authorization[len("Basic ") :]).decode("utf-8").partition(":")[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--services", type=int, default=6, help="Number of services, named svc0, svc1...")
+    parser.add_argument("--stacks", type=int, default=1, help="Number of stacks the services are spread over")
+    parser.add_argument("--environments", type=int, default=1, help="Number of environments, with the same services")
+    parser.add_argument("--scale", type=int, default=2, help="Number of containers of each service")
+    parser.add_argument("--delay", type=float, default=0.5, help="Seconds each state transition takes")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--hosts", type=int, default=3, help="Number of hosts the containers are spread over")
+    parser.add_argument("--pull-delay", type=float, default=0.0, help="Seconds a host takes to pull an image")
+    parser.add_argument(
+        "--drop-events", type=float, default=None, help="Seconds after which the event websockets are closed"
+    )
+    parser.add_argument(
+        "--batch-delay", type=float, default=0.0, help="Seconds each batch of an upgrade takes, instead of spreading --delay"
+    )
+    args = parser.parse_args()
+
+    fake = FakeRancher(
+        args.services,
+        args.stacks,
+        args.scale,
+        args.delay,
+        args.latency,
+        environments=args.environments,
+        hosts=args.hosts,
+        pull_delay=args.pull_delay,
+        batch_delay=args.batch_delay,
+        drop_events=args.drop_events,
+    )
+    print("Serving %d services on %s" % (args.services, fake.start(args.host, args.port)))
+
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
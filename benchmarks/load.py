@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""Runs rancher-gitlab-deploy against the fake Rancher server, and measures what each deploy costs
+
+Every deploy is a separate process, like in a CI job, using its own API key so the fake server can
+count its requests and bytes. For each scenario this prints the wall time of the deploys and the
+number of requests and bytes they sent to Rancher:
+
+    python benchmarks/load.py
+    python benchmarks/load.py --scenario large-environment --latency 0.02
+    python benchmarks/load.py --json results.json
+    python benchmarks/load.py --baseline results.json
+
+With --baseline, exits with 1 if a scenario now makes more requests than it did in the baseline (by
+more than --tolerance, as the number of polls depends on timing), to catch API call volume
+regressions before they reach a shared Rancher.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_rancher import FakeRancher  # noqa: E402
+
+# arguments passed to every deploy, on top of the scenario's
+COMMON_ARGS = ["--batch-interval", "0"]
+
+
+def deploy(service, image="registry.example.com/app:2", stack="stack0"):
+    return ["--stack", stack, "--service", service, "--new-image", image]
+
+
+def single(fake, workdir):
+    """One service upgraded in a small environment"""
+    return [[deploy("svc0")]]
+
+
+def large_environment(fake, workdir):
+    """One service upgraded in an environment of 10,000 services"""
+    return [[deploy("svc9999")]]
+
+
+def manifest(fake, workdir):
+    """20 services of a manifest, in 4 chains of 5 that depend on each other"""
+    path = os.path.join(workdir, "manifest.json")
+    services = []
+    for number in range(20):
+        entry = {"service": "svc%d" % number, "image": "registry.example.com/app:2"}
+        if number % 5:
+            entry["depends_on"] = ["svc%d" % (number - 1)]
+        services.append(entry)
+
+    with open(path, "w") as f:
+        json.dump({"stack": "stack0", "services": services}, f)
+
+    return [[["--manifest", path, "--parallel", "4"]]]
+
+
+def concurrent(fake, workdir):
+    """50 deploys of different services at the same time, like 50 pipelines finishing together"""
+    return [[deploy("svc%d" % number) for number in range(50)]]
+
+
+def cached(fake, workdir):
+    """The same service deployed twice with --cache-dir, the second deploy skips the lookups"""
+    args = deploy("svc0") + ["--cache-dir", os.path.join(workdir, "cache")]
+    return [[args], [args[:5] + ["registry.example.com/app:3"] + args[6:]]]
+
+
+def fleet(fake, workdir):
+    """The base image of 20 services in each of 3 environments, rolled out by one --select-image deploy"""
+    args = ["--select-image", "registry.example.com/base", "--new-image", "registry.example.com/base:2", "--parallel", "10"]
+    for project in fake.projects:
+        args += ["--environment", project["name"]]
+    return [[args]]
+
+
+def canary(fake, workdir):
+    """A service of 10 containers upgraded with --canary 10, checking the health for 1s at 1, 2, 4, 8 and 10"""
+    return [[deploy("svc0") + ["--canary", "10", "--canary-wait", "1"]]]
+
+
+def rollback(fake, workdir):
+    """An image whose containers crash, caught by --watch-containers and rolled back (the deploy fails)"""
+    return [[deploy("svc0", "registry.example.com/crash:2") + ["--watch-containers", "--rollback-on-error"]]]
+
+
+def pre_pull(fake, workdir):
+    """A service of 6 containers on 6 hosts that take 1s to pull an image, upgraded without then with --pre-pull"""
+    return [[deploy("svc1")], [deploy("svc1", "registry.example.com/app:3") + ["--pre-pull"]]]
+
+
+def events(fake, workdir):
+    """A service upgraded polling its state, then following the event stream with --events"""
+    return [[deploy("svc1")], [deploy("svc1", "registry.example.com/app:3") + ["--events"]]]
+
+
+def events_dropped(fake, workdir):
+    """A service upgraded with --events, the event stream closing after 1s, in the middle of the wait"""
+    return [[deploy("svc1") + ["--events"]]]
+
+
+# name: (scenario, options of the fake server)
+SCENARIOS = {
+    "single": (single, {"services": 6}),
+    "large-environment": (large_environment, {"services": 10000}),
+    "manifest": (manifest, {"services": 20}),
+    "concurrent": (concurrent, {"services": 50}),
+    "cached": (cached, {"services": 6}),
+    "fleet": (fleet, {"services": 60, "environments": 3}),
+    "canary": (canary, {"services": 6, "scale": 10}),
+    "rollback": (rollback, {"services": 6}),
+    "pre-pull": (pre_pull, {"services": 6, "scale": 6, "hosts": 6, "pull_delay": 1.0}),
+    "events": (events, {"services": 6}),
+    "events-dropped": (events_dropped, {"services": 6, "drop_events": 1.0}),
+}
+
+
+def run_round(fake, deploys, first_key, extra_args):
+    """Starts the deploys at the same time and waits for all of them, returns one result per deploy"""
+    processes = []
+    for number, args in enumerate(deploys):
+        key = "bench-%d" % (first_key + number)
+        env = dict(os.environ, RANCHER_URL=fake.url, RANCHER_ACCESS_KEY=key, RANCHER_SECRET_KEY="secret")
+        command = [sys.executable, "-c", "from rancher_gitlab_deploy.cli import main; main()"]
+        command += COMMON_ARGS + args + extra_args
+        process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        processes.append((key, time.monotonic(), process))
+
+    results = []
+    for key, started, process in processes:
+        output = process.communicate()[0]
+        stats = fake.stats.get(key, {"requests": 0, "bytes_received": 0, "bytes_sent": 0})
+        results.append(
+            {
+                "seconds": time.monotonic() - started,
+                "exit_code": process.returncode,
+                "requests": stats["requests"],
+                "bytes_sent": stats["bytes_received"],  # sent by the deploy, received by the fake server
+                "bytes_received": stats["bytes_sent"],
+                "output": output.decode("utf-8", "replace"),
+            }
+        )
+
+    return results
+
+
+def run_scenario(name, delay, latency, extra_args):
+    scenario, options = SCENARIOS[name]
+    fake = FakeRancher(delay=delay, latency=latency, **options)
+    fake.start()
+
+    rounds = []
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            first_key = 0
+            for deploys in scenario(fake, workdir):
+                started = time.monotonic()
+                results = run_round(fake, deploys, first_key, extra_args)
+                rounds.append({"seconds": time.monotonic() - started, "deploys": results})
+                first_key += len(deploys)
+    finally:
+        fake.stop()
+
+    return {"scenario": name, "description": scenario.__doc__, "rounds": rounds}
+
+
+def summarize(result):
+    """One line per round: deploys, exit codes, wall time and the requests and bytes per deploy"""
+    lines = []
+    for number, round in enumerate(result["rounds"]):
+        deploys = round["deploys"]
+        failed = len([d for d in deploys if d["exit_code"]])
+        lines.append(
+            "%-18s %2d  %4d deploy(s) %3d failed  %7.2fs  p50 %6.2fs  %6.1f requests  %9.0f bytes sent  %10.0f received"
+            % (
+                result["scenario"],
+                number + 1,
+                len(deploys),
+                failed,
+                round["seconds"],
+                statistics.median(d["seconds"] for d in deploys),
+                statistics.mean(d["requests"] for d in deploys),
+                statistics.mean(d["bytes_sent"] for d in deploys),
+                statistics.mean(d["bytes_received"] for d in deploys),
+            )
+        )
+    return lines
+
+
+def regressions(results, baseline, tolerance):
+    """Lists the rounds that make more requests per deploy than in the baseline"""
+    previous = dict((result["scenario"], result) for result in baseline)
+    found = []
+
+    for result in results:
+        if result["scenario"] not in previous:
+            continue
+
+        for number, (now, before) in enumerate(zip(result["rounds"], previous[result["scenario"]]["rounds"])):
+            requests = statistics.mean(d["requests"] for d in now["deploys"])
+            allowed = statistics.mean(d["requests"] for d in before["deploys"]) * (1 + tolerance)
+            if requests > allowed:
+                found.append(
+                    "%s round %d: %.1f requests per deploy, %.1f allowed"
+                    % (result["scenario"], number + 1, requests, allowed)
+                )
+
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="Scenario to run (default: all)")
+    parser.add_argument("--delay", type=float, default=0.5, help="Seconds each state transition takes in the fake server")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request by the fake server")
+    parser.add_argument("--json", default=None, help="Write the results to this file")
+    parser.add_argument("--baseline", default=None, help="Compare the requests per deploy with the results in this file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="How many more requests than the baseline are allowed")
+    parser.add_argument("--verbose", action="store_true", help="Print the output of the deploys")
+    parser.add_argument("args", nargs="*", help="Extra arguments for rancher-gitlab-deploy, after --")
+    args = parser.parse_args()
+
+    results = []
+    for name in args.scenario or list(SCENARIOS):
+        result = run_scenario(name, args.delay, args.latency, args.args)
+        results.append(result)
+
+        for line in summarize(result):
+            print(line)
+
+        if args.verbose:
+            for round in result["rounds"]:
+                for deploy in round["deploys"]:
+                    print(deploy["output"])
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+
+        for line in found:
+            print("More requests than the baseline: %s" % line)
+
+        if found:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
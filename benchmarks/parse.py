@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Measures how long a listing of services takes to parse, and the memory it needs
+
+Rancher sends every service with its links, actions and whole launch config, so the listing of a large
+environment is many megabytes. This builds such a listing and parses it the way the client does, as it
+would be downloaded, keeping only the fields discovery needs, next to decoding it all at once:
+
+    python benchmarks/parse.py
+    python benchmarks/parse.py --services 20000 --runs 10
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rancher_gitlab_deploy.client import SERVICE_FIELDS  # noqa: E402
+from rancher_gitlab_deploy.stream import CHUNK_SIZE  # noqa: E402
+from rancher_gitlab_deploy.stream import CollectionStream  # noqa: E402
+
+
+def service(number):
+    """A service as Rancher lists it, with the links and actions it sends along"""
+    url = "https://rancher.example.com/v1/projects/1a5/services/1s%d" % number
+    links = ["account", "consumedservices", "consumedbyservices", "environment", "instances", "serviceLogs", "stack"]
+    actions = ["upgrade", "restart", "update", "remove", "deactivate", "setservicelinks", "finishupgrade", "rollback"]
+
+    return {
+        "id": "1s%d" % number,
+        "type": "service",
+        "name": "svc%d" % number,
+        "state": "active",
+        "stackId": "1st1",
+        "accountId": "1a5",
+        "scale": 2,
+        "links": dict((name, "%s/%s" % (url, name)) for name in links),
+        "actions": dict((name, "%s/?action=%s" % (url, name)) for name in actions),
+        "launchConfig": {
+            "type": "launchConfig",
+            "kind": "container",
+            "imageUuid": "docker:registry.example.com/app:1",
+            "labels": {"io.rancher.container.pull_image": "always", "tier": "web"},
+            "environment": dict(("VARIABLE_%d" % index, "value-%d" % index) for index in range(10)),
+            "networkMode": "managed",
+            "logConfig": {"type": "logConfig", "driver": "", "config": {}},
+        },
+        "secondaryLaunchConfigs": [],
+        "instanceIds": ["1i%d" % (number * 2), "1i%d" % (number * 2 + 1)],
+        "healthState": "healthy",
+        "created": "2020-01-01T00:00:00Z",
+        "uuid": "%032x" % number,
+    }
+
+
+def listing(services):
+    document = {
+        "type": "collection",
+        "resourceType": "service",
+        "links": {"self": "https://rancher.example.com/v1/projects/1a5/services"},
+        "data": [service(number) for number in range(services)],
+        "pagination": {"next": None, "limit": 1000, "partial": False},
+        "filters": {},
+    }
+    return json.dumps(document).encode("utf-8")
+
+
+def decode_all(body):
+    return json.loads(body.decode("utf-8"))["data"]
+
+
+def stream(body):
+    chunks = (body[start : start + CHUNK_SIZE] for start in range(0, len(body), CHUNK_SIZE))
+    return list(CollectionStream(chunks, SERVICE_FIELDS))
+
+
+def measure(parse, body, runs):
+    """Returns the median time and the peak memory of parsing body"""
+    seconds = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        parse(body)
+        seconds.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    parse(body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return statistics.median(seconds), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--services", type=int, default=10000, help="Number of services in the listing")
+    parser.add_argument("--runs", type=int, default=5, help="Number of times each parse is timed")
+    args = parser.parse_args()
+
+    body = listing(args.services)
+    print("listing of %d services: %.1f MB" % (args.services, len(body) / 1e6))
+
+    for name, parse in (("decoded at once", decode_all), ("streamed", stream)):
+        seconds, peak = measure(parse, body, args.runs)
+        print("%-16s %7.0f ms  peak %6.1f MB" % (name, seconds * 1000, peak / 1e6))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Measures how long rancher-gitlab-deploy takes to start, from python -X importtime
+
+Every CI job pays for the startup of the tool, so this runs the import of the command line in fresh
+interpreters and reports the median total, the slowest imports, and any module imported at startup
+that should only be imported when an option needs it. Use it to compare branches:
+
+    python benchmarks/startup.py --runs 20
+    python benchmarks/startup.py --max-ms 150 --json startup.json
+
+Exits with 1 if the median is over --max-ms, or if one of the lazy modules was imported.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# modules only some options need (--events, YAML manifests, --junit-file, AsyncRancherClient)
+LAZY_MODULES = ["asyncio", "websocket", "yaml", "xml.etree.ElementTree"]
+
+
+def import_times(python, module):
+    """Returns {module: (self us, cumulative us)} for one import of module in a new interpreter"""
+    result = subprocess.run(
+        [python, "-X", "importtime", "-c", "import %s" % module],
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        universal_newlines=True,
+        check=True,
+    )
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+
+        own, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = (int(own), int(cumulative))
+
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--python", default=sys.executable, help="Interpreter to measure (default: this one)")
+    parser.add_argument("--module", default="rancher_gitlab_deploy.cli", help="Module imported by the entry point")
+    parser.add_argument("--runs", type=int, default=10, help="Number of interpreters to start")
+    parser.add_argument("--top", type=int, default=15, help="Number of slowest imports to list")
+    parser.add_argument("--max-ms", type=float, default=None, help="Fail if the median import takes longer")
+    parser.add_argument("--json", default=None, help="Write the results to this file, to keep track of them over time")
+    args = parser.parse_args()
+
+    # the first run also writes the .pyc files, it isn't counted
+    import_times(args.python, args.module)
+    runs = [import_times(args.python, args.module) for _ in range(args.runs)]
+
+    totals = [run[args.module][1] / 1000.0 for run in runs]
+    median = statistics.median(totals)
+
+    cumulative = {}
+    for run in runs:
+        for name, (_, us) in run.items():
+            cumulative.setdefault(name, []).append(us / 1000.0)
+    slowest = sorted(((statistics.median(ms), name) for name, ms in cumulative.items()), reverse=True)
+
+    imported = [name for name in LAZY_MODULES if name in runs[0]]
+
+    print(
+        "import %s: median %.1fms, min %.1fms, max %.1fms over %d runs"
+        % (args.module, median, min(totals), max(totals), len(runs))
+    )
+    print("slowest imports (cumulative):")
+    for ms, name in slowest[: args.top]:
+        print("  %8.1fms  %s" % (ms, name))
+
+    if imported:
+        print("imported at startup, but should only be imported when needed: %s" % ", ".join(imported))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "module": args.module,
+                    "median_ms": median,
+                    "runs_ms": totals,
+                    "slowest": [{"module": name, "ms": ms} for ms, name in slowest[: args.top]],
+                    "lazy_imported": imported,
+                },
+                f,
+                indent=2,
+            )
+
+    if args.max_ms is not None and median > args.max_ms:
+        print("median startup %.1fms is over the %.1fms budget" % (median, args.max_ms))
+        return 1
+
+    return 1 if imported else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class LookupCache(object):
+    """Remembers the ids of environments, stacks and services between runs, in a JSON file
+
+    The file name is derived from the Rancher URL and the API key, so that one cache directory
+    can be shared by jobs deploying to different Rancher servers or with different credentials.
+    """
+
+    def __init__(self, directory, rancher_url, rancher_key, ttl):
+        fingerprint = hashlib.sha256(("%s\0%s" % (rancher_url, rancher_key)).encode("utf-8")).hexdigest()[:16]
+        self.directory = directory
+        self.path = os.path.join(directory, "rancher-gitlab-deploy-%s.json" % fingerprint)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def get(self, *key):
+        """Returns the value stored under key, or None if there isn't one or it has expired"""
+        with self.lock:
+            entry = self.entries.get(self._key(key))
+
+        if entry is None or entry["expires"] < time.time():
+            return None
+
+        return entry["value"]
+
+    def set(self, value, *key, ttl=None):
+        """Stores value under key, for ttl seconds (the ttl of the cache by default)"""
+        with self.lock:
+            self.entries[self._key(key)] = {"value": value, "expires": time.time() + (ttl or self.ttl)}
+            self._save()
+
+    def invalidate(self, *key):
+        with self.lock:
+            if self.entries.pop(self._key(key), None) is not None:
+                self._save()
+
+    def _key(self, key):
+        return "/".join(str(part).lower() for part in key)
+
+    def _save(self):
+        now = time.time()
+        entries = dict((key, entry) for key, entry in self.entries.items() if entry["expires"] >= now)
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+
+            # write to a temporary file first, so concurrent jobs never read half a file
+            tmp = "%s.%d.tmp" % (self.path, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.path)
+        except (IOError, OSError):
+            pass  # the cache is only an optimisation
+
+
+class MemoryCache(LookupCache):
+    """A LookupCache that only lives as long as the process, for the resident --serve agent"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def _save(self):
+        pass
@@ -0,0 +1,154 @@
+import math
+import time
+
+import requests
+
+from rancher_gitlab_deploy.client import ContainerFailed
+from rancher_gitlab_deploy.client import HealthCheckFailed
+from rancher_gitlab_deploy.client import WaitTimeout
+from rancher_gitlab_deploy.deploy import container_problem
+
+
+def canary_stages(total, percent):
+    """Returns the numbers of new containers to check the health of: percent of total, doubling until all of them"""
+    count = max(1, int(math.ceil(total * percent / 100.0)))
+    stages = []
+    while count < total:
+        stages.append(count)
+        count *= 2
+    return stages + [total]
+
+
+class HttpProbe(object):
+    """Checks that a URL answers with a 2xx status, as the health signal of the new containers"""
+
+    def __init__(self, url, timeout=5):
+        self.url = url
+        self.timeout = timeout
+
+    def check(self):
+        try:
+            r = requests.get(self.url, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise HealthCheckFailed("The health probe %s failed: %s" % (self.url, e))
+
+        if not 200 <= r.status_code < 300:
+            raise HealthCheckFailed("The health probe %s answered with a %d status" % (self.url, r.status_code))
+
+
+class Canary(object):
+    """Drives an in service upgrade in stages, checking the health of the new containers between them
+
+    Rancher is let to upgrade a first percent of the containers, then the upgrade is paused (with the
+    cancelupgrade action) while the new containers, and the probe if there is one, are checked for
+    canary_wait seconds. If they stay healthy the upgrade is continued up to twice as many containers,
+    and so on until they are all upgraded. A failed check raises ContainerFailed (or HealthCheckFailed
+    for the probe), for the caller to roll the upgrade back.
+    """
+
+    def __init__(self, client, environment, service, options, log):
+        self.client = client
+        self.environment = environment
+        self.options = options
+        self.log = log
+        self.probe = HttpProbe(options["canary_probe_url"]) if options["canary_probe_url"] else None
+
+        # the containers before the upgrade, so the new ones can be told apart
+        self.previous = set(instance["id"] for instance in client.list_instances(environment, service))
+        self.total = service.get("scale") or len(self.previous)
+        self.stages = canary_stages(self.total, options["canary"])
+
+    def promote(self, service, phase_key):
+        """Runs the stages of the upgrade once it has been started, returns the service once it's upgraded"""
+        timings = self.client.timings
+
+        for count in self.stages:
+            timings.phase(phase_key, "canary %d/%d" % (count, self.total))
+            last = count == self.total
+
+            if not last:
+                service = self.wait_for_containers(service, count)
+                # Rancher may have upgraded the rest before the upgrade could be paused
+                last = service["state"] == "upgraded"
+
+            if last:
+                count = self.total
+                service = self.wait(
+                    service, "upgraded", "A timeout occured while waiting for Rancher to complete the upgrade"
+                )
+            else:
+                self.client.action(self.environment, service, "cancelupgrade", "Unable to pause the upgrade in Rancher")
+                service = self.wait(
+                    service, "canceled-upgrade", "A timeout occured while waiting for Rancher to pause the upgrade"
+                )
+
+            self.log.msg(
+                "%d/%d containers upgraded, checking their health for %ss..."
+                % (count, self.total, self.options["canary_wait"])
+            )
+            self.observe(service)
+
+            if last:
+                break
+
+            self.log.msg("Healthy, continuing the upgrade")
+            self.client.action(self.environment, service, "continueupgrade", "Unable to continue the upgrade in Rancher")
+
+        self.log.msg("All the containers are upgraded and healthy")
+        return service
+
+    def new_containers(self, service):
+        new = [i for i in self.client.list_instances(self.environment, service) if i["id"] not in self.previous]
+
+        for instance in new:
+            problem = container_problem(instance, self.options["max_restarts"])
+            if problem:
+                raise ContainerFailed("The new container %s %s" % (instance.get("name") or instance["id"], problem))
+
+        return new
+
+    def wait_for_containers(self, service, count):
+        """Waits until count new containers are up, or until the whole service is upgraded"""
+        deadline = time.monotonic() + self.options["upgrade_timeout"]
+
+        while True:
+            new = self.new_containers(service)
+            up = len([i for i in new if i["state"] == "running" and i.get("healthState") in (None, "healthy")])
+
+            service = self.client.get_service(self.environment, service)
+            self.client.timings.count("polls")
+            if up >= count or service["state"] == "upgraded":
+                return service
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise WaitTimeout("A timeout occured while waiting for %d new containers to start" % count)
+
+            time.sleep(min(self.options["poll_interval"], remaining))
+
+    def observe(self, service):
+        """Checks the new containers and the probe every poll interval, for canary_wait seconds"""
+        deadline = time.monotonic() + self.options["canary_wait"]
+
+        while True:
+            self.new_containers(service)
+            if self.probe is not None:
+                self.probe.check()
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+
+            time.sleep(min(self.options["poll_interval"], remaining))
+
+    def wait(self, service, state, timeout_message):
+        return self.client.wait(
+            self.environment,
+            service,
+            state,
+            self.options["upgrade_timeout"],
+            timeout_message,
+            poll_interval=self.options["poll_interval"],
+            poll_max_interval=self.options["poll_max_interval"],
+            check=lambda service: self.new_containers(service),
+        )
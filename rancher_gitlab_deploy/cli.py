@@ -1,35 +1,46 @@
 #!/usr/bin/env python
-import logging
+import json
 import sys
 import time
 
 import click
-import requests
-from requests import HTTPError
 
-try:
-    from httplib import HTTPConnection  # py2
-except ImportError:
-    from http.client import HTTPConnection  # py3
+from rancher_gitlab_deploy.cache import LookupCache
+from rancher_gitlab_deploy.cache import MemoryCache
+from rancher_gitlab_deploy.client import DeployError
+from rancher_gitlab_deploy.client import RancherClient
+from rancher_gitlab_deploy.deploy import FAILED
+from rancher_gitlab_deploy.deploy import Log
+from rancher_gitlab_deploy.deploy import display_name
+from rancher_gitlab_deploy.deploy import link_created
+from rancher_gitlab_deploy.deploy import new_target
+from rancher_gitlab_deploy.deploy import run_in_order
+from rancher_gitlab_deploy.deploy import run_target
+from rancher_gitlab_deploy.fleet import RateLimit
+from rancher_gitlab_deploy.fleet import discover
+from rancher_gitlab_deploy.fleet import interleave
+from rancher_gitlab_deploy.fleet import parse_selector
+from rancher_gitlab_deploy.manifest import load_manifest
+from rancher_gitlab_deploy.timings import Timings
 
 
 @click.command()
 @click.option(
     "--rancher-url",
     envvar="RANCHER_URL",
-    required=True,
-    help="The URL for your Rancher server, eg: http://rancher:8000",
+    default=None,
+    help="The URL for your Rancher server, eg: http://rancher:8000 (not needed with --snapshot)",
 )
 @click.option(
     "--rancher-key",
     envvar="RANCHER_ACCESS_KEY",
-    required=True,
+    default=None,
     help="The environment or account API key",
 )
 @click.option(
     "--rancher-secret",
     envvar="RANCHER_SECRET_KEY",
-    required=True,
+    default=None,
     help="The secret for the access API key",
 )
 @click.option(
@@ -42,23 +53,60 @@ except ImportError:
 @click.option(
     "--environment",
     default=None,
+    multiple=True,
     help="The name of the environment to add the host into "
-    + "(only needed if you are using an account API key instead of an environment API key)",
+    + "(only needed if you are using an account API key instead of an environment API key). "
+    + "Can be given multiple times with --select or --select-image",
 )
 @click.option(
     "--stack",
     envvar="CI_PROJECT_NAMESPACE",
     default=None,
-    required=True,
     help="The name of the stack in Rancher (defaults to the name of the group in GitLab)",
 )
 @click.option(
     "--service",
     envvar="CI_PROJECT_NAME",
     default=None,
-    required=True,
     help="The name of the service in Rancher to upgrade (defaults to the name of the service in GitLab)",
 )
+@click.option(
+    "--target",
+    default=None,
+    multiple=True,
+    help="If specified, upgrade this stack/service instead of --stack and --service. "
+    + "Can be given multiple times, optionally as stack/service=image to override --new-image for that service",
+)
+@click.option(
+    "--manifest",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="If specified, upgrade the services listed in this YAML or JSON file, in the order given by their depends_on",
+)
+@click.option(
+    "--parallel",
+    default=4,
+    help="Number of --target, --manifest, --select or --serve services to upgrade at the same time",
+)
+@click.option(
+    "--select",
+    default=None,
+    multiple=True,
+    help="If specified, upgrade every service with this label to --new-image, in all the given environments. "
+    + "Can be key=value, key!=value or key, and given multiple times to select the services matching all of them",
+)
+@click.option(
+    "--select-image",
+    default=None,
+    multiple=True,
+    help="If specified, upgrade every service or sidekick running an image from this repository (eg. registry.example.com/base) "
+    + "to --new-image, in all the given environments. Can be given multiple times",
+)
+@click.option(
+    "--environment-rate",
+    default=0.0,
+    help="With --select or --select-image, the maximum number of upgrades to start per minute in each environment (0 for no limit)",
+)
 @click.option(
     "--start-before-stopping/--no-start-before-stopping",
     default=False,
@@ -74,21 +122,109 @@ except ImportError:
     default=2,
     help="Number of seconds to wait between upgrade batches",
 )
+@click.option(
+    "--rollout-time",
+    default=None,
+    type=int,
+    help="If specified, choose the --batch-size (and if needed a shorter --batch-interval) of each service to upgrade all its containers in about this many seconds, "
+    + "from its scale and how long its batches took in the previous upgrades remembered in --cache-dir",
+)
+@click.option(
+    "--min-healthy",
+    default=75,
+    type=click.IntRange(0, 100),
+    help="With --rollout-time, the percentage of the containers of a service kept running while it's upgraded",
+)
 @click.option(
     "--upgrade-timeout",
     default=5 * 60,
     help="How long to wait, in seconds, for the upgrade to finish before exiting. To skip the wait, pass the --no-wait-for-upgrade-to-finish option.",
 )
+@click.option(
+    "--poll-interval",
+    default=1.0,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Number of seconds to wait before polling Rancher again for the service state. The wait grows after each poll, up to --poll-max-interval",
+)
+@click.option(
+    "--poll-max-interval",
+    default=10.0,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Maximum number of seconds to wait between two polls of the service state",
+)
+@click.option(
+    "--events/--no-events",
+    default=False,
+    help="Follow the service state through Rancher's event stream instead of polling for it. Needs the websocket-client package, falls back to polling if the stream can't be used",
+)
 @click.option(
     "--wait-for-upgrade-to-finish/--no-wait-for-upgrade-to-finish",
     default=True,
     help="Wait for Rancher to finish the upgrade before this tool exits",
 )
+@click.option(
+    "--watch-containers/--no-watch-containers",
+    default=False,
+    help="While waiting for the upgrade, follow the new containers to report progress, "
+    + "and fail as soon as one is in error, unhealthy or keeps restarting instead of waiting for --upgrade-timeout",
+)
+@click.option(
+    "--max-restarts",
+    default=3,
+    help="With --watch-containers, how many times a new container can restart before the upgrade is considered failed",
+)
 @click.option(
     "--rollback-on-error/--no-rollback-on-error",
     default=False,
     help="Rollback the upgrade if an error occured. The rollback will be performed only if the option --wait-for-upgrade-to-finish is passed",
 )
+@click.option(
+    "--canary",
+    default=0,
+    type=click.IntRange(0, 100),
+    help="If specified, upgrade this percentage of the containers first, and check they stay healthy for --canary-wait seconds "
+    + "before upgrading twice as many, and so on. The upgrade is rolled back if a check fails",
+)
+@click.option(
+    "--canary-wait",
+    default=30,
+    help="With --canary, how long, in seconds, the new containers must stay healthy before more are upgraded",
+)
+@click.option(
+    "--canary-probe-url",
+    default=None,
+    help="With --canary, a URL that must answer with a 2xx status while the new containers are checked, eg. a health endpoint of the service",
+)
+@click.option(
+    "--pre-pull/--no-pre-pull",
+    default=False,
+    help="Pull the new images on every host that has a version of them, all at the same time, before starting the upgrade",
+)
+@click.option(
+    "--lock",
+    default=None,
+    type=click.Choice(["rancher", "file"]),
+    help="If specified, wait for the other deploys of the service to finish, and skip this one if a newer one is waiting too. "
+    + "The lock is kept in the metadata of the service in Rancher, or in a file in --lock-dir for runners sharing a host",
+)
+@click.option(
+    "--lock-dir",
+    envvar="RANCHER_GITLAB_DEPLOY_LOCK_DIR",
+    default=None,
+    help="With --lock file, the directory of the lock files, the temporary directory by default",
+)
+@click.option(
+    "--lock-order",
+    envvar="CI_PIPELINE_ID",
+    default=None,
+    type=float,
+    help="With --lock, what tells the newer deploys apart, the pipeline id in GitLab CI or the start time by default",
+)
+@click.option(
+    "--lock-timeout",
+    default=30 * 60,
+    help="With --lock, how long, in seconds, to wait for the other deploys of the service",
+)
 @click.option(
     "--new-image",
     default=None,
@@ -99,6 +235,12 @@ except ImportError:
     default=True,
     help="Mark the upgrade as finished after it completes",
 )
+@click.option(
+    "--skip-unchanged/--no-skip-unchanged",
+    default=False,
+    help="Don't upgrade the service if its image, labels, variables and sidekick images already match the ones requested. "
+    + "Images are compared by name, so an image pushed again with the same tag isn't deployed",
+)
 @click.option(
     "--sidekicks/--no-sidekicks",
     default=False,
@@ -157,6 +299,102 @@ except ImportError:
     default=None,
     help="If specified, service will be deployed on requested host",
 )
+@click.option(
+    "--cache-dir",
+    envvar="RANCHER_GITLAB_DEPLOY_CACHE_DIR",
+    default=None,
+    help="If specified, remember the ids of the environment, stack and service in this directory, to skip looking them up on the next run. "
+    + "Use a path listed in the cache:paths of your .gitlab-ci.yml",
+)
+@click.option(
+    "--cache-ttl",
+    default=24 * 60 * 60,
+    help="How long, in seconds, the ids in --cache-dir are remembered for",
+)
+@click.option(
+    "--serve",
+    default=None,
+    metavar="HOST:PORT",
+    help="If specified, run as an agent that upgrades the services POSTed to http://HOST:PORT/deploys (as JSON, or by a GitLab "
+    + "pipeline webhook), --parallel at a time, reusing its connections and lookups from one deploy to the next",
+)
+@click.option(
+    "--serve-token",
+    envvar="RANCHER_GITLAB_DEPLOY_SERVE_TOKEN",
+    default=None,
+    help="With --serve, the token the requests must give, as a bearer token or as the secret token of the GitLab webhook",
+)
+@click.option(
+    "--plan",
+    is_flag=True,
+    default=False,
+    help="Print the request each service would be upgraded (or created) with, and the changes to its launch configs, without upgrading it",
+)
+@click.option(
+    "--snapshot",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="With --plan, compute the plan from the environments saved in this file by --save-snapshot, without talking to Rancher",
+)
+@click.option(
+    "--save-snapshot",
+    default=None,
+    help="With --plan, save the stacks, services and secrets of the environments in this file, for --snapshot",
+)
+@click.option(
+    "--report-file",
+    default=None,
+    help="If specified, write a JSON report of the deploy, with the time spent in each phase and on each request to Rancher",
+)
+@click.option(
+    "--junit-file",
+    default=None,
+    help="If specified, write a JUnit XML report of the deploy, for the artifacts:reports:junit of your .gitlab-ci.yml",
+)
+@click.option(
+    "--metrics-file",
+    default=None,
+    help="If specified, write the metrics of the deploy (phase durations, polls, API request latencies, retries, statuses) "
+    + "in the Prometheus text format, eg. for the textfile collector of the node exporter",
+)
+@click.option(
+    "--metrics-push-url",
+    envvar="RANCHER_GITLAB_DEPLOY_METRICS_PUSH_URL",
+    default=None,
+    help="If specified, push the metrics of the deploy to this Prometheus Pushgateway group, "
+    + "eg. http://pushgateway:9091/metrics/job/deploy/pipeline/$CI_PIPELINE_ID",
+)
+@click.option(
+    "--record",
+    default=None,
+    help="If specified, save every request to the Rancher API, its response and how long it took to this gzipped file. "
+    + "The API keys and the values of variables and secrets aren't saved, but the rest of the configuration of the services is",
+)
+@click.option(
+    "--replay",
+    default=None,
+    help="If specified, answer the requests of the deploy from a --record file instead of Rancher, to profile it offline",
+)
+@click.option(
+    "--replay-latency",
+    default=1.0,
+    help="With --replay, how much of the time each recorded request took to wait before answering it, eg. 0.5 for half of it, or 0",
+)
+@click.option(
+    "--connect-timeout",
+    default=10.0,
+    help="How long to wait, in seconds, for a connection to Rancher",
+)
+@click.option(
+    "--read-timeout",
+    default=60.0,
+    help="How long to wait, in seconds, for Rancher to answer a request",
+)
+@click.option(
+    "--retries",
+    default=3,
+    help="How many times to retry a request to Rancher that failed to connect, or a status request that failed with a 502, 503 or 504",
+)
 @click.option(
     "--debug/--no-debug",
     default=False,
@@ -186,14 +424,36 @@ def main(
     environment,
     stack,
     service,
+    target,
+    manifest,
+    parallel,
+    select,
+    select_image,
+    environment_rate,
     new_image,
     batch_size,
     batch_interval,
+    rollout_time,
+    min_healthy,
     start_before_stopping,
     upgrade_timeout,
+    poll_interval,
+    poll_max_interval,
+    events,
     wait_for_upgrade_to_finish,
+    watch_containers,
+    max_restarts,
     rollback_on_error,
+    canary,
+    canary_wait,
+    canary_probe_url,
+    pre_pull,
+    lock,
+    lock_dir,
+    lock_order,
+    lock_timeout,
     finish_upgrade,
+    skip_unchanged,
     sidekicks,
     new_sidekick_image,
     create,
@@ -204,6 +464,23 @@ def main(
     service_links,
     service_link,
     host_id,
+    cache_dir,
+    cache_ttl,
+    serve,
+    serve_token,
+    plan,
+    snapshot,
+    save_snapshot,
+    report_file,
+    junit_file,
+    metrics_file,
+    metrics_push_url,
+    record,
+    replay,
+    replay_latency,
+    connect_timeout,
+    read_timeout,
+    retries,
     debug,
     ssl_verify,
     secrets,
@@ -213,24 +490,122 @@ def main(
     if debug:
         debug_requests_on()
 
-    # split url to protocol and host
-    if "://" not in rancher_url:
-        bail("The Rancher URL doesn't look right")
+    fleet = bool(select or select_image)
+
+    if (snapshot or save_snapshot) and not plan:
+        bail("--snapshot and --save-snapshot can only be used with --plan")
 
-    proto, host = rancher_url.split("://")
-    api = "%s://%s/v1" % (proto, host)
-    apiv2 = "%s://%s/v2-beta" % (proto, host)
+    if record and (replay or snapshot):
+        bail("--record can't be combined with --replay or --snapshot, there are no requests to Rancher to record")
 
-    stack = stack.replace(".", "-")
-    service = service.replace(".", "-")
+    if replay and (events or canary_probe_url):
+        bail("--replay can't be combined with --events or --canary-probe-url, the recording only has the API requests")
 
-    session = requests.Session()
+    if replay:
+        from rancher_gitlab_deploy.transport import Replay
 
-    # Set verify based on --ssl-verify/--no-ssl-verify option
-    session.verify = ssl_verify
+        try:
+            replay = Replay(replay, replay_latency)
+        except (IOError, OSError, ValueError, KeyError) as e:
+            bail("Unable to read the recording: %s" % e)
+
+        # the recorded deploy's Rancher, no API keys are needed to answer from the recording
+        rancher_url = rancher_url or replay.url
+        rancher_key = rancher_key or "replay"
+        rancher_secret = rancher_secret or "replay"
+
+    if not snapshot:
+        credentials = {"--rancher-url": rancher_url, "--rancher-key": rancher_key, "--rancher-secret": rancher_secret}
+        for name in ("--rancher-url", "--rancher-key", "--rancher-secret"):
+            if not credentials[name]:
+                bail("Missing option '%s'" % name)
 
-    # 0 -> Authenticate all future requests
-    session.auth = (rancher_key, rancher_secret)
+    if canary and not wait_for_upgrade_to_finish:
+        bail("--canary needs to wait for the upgrade, it can't be used with --no-wait-for-upgrade-to-finish")
+
+    if lock and not wait_for_upgrade_to_finish:
+        bail("--lock needs to wait for the upgrade, it can't be used with --no-wait-for-upgrade-to-finish")
+
+    if serve:
+        if fleet or target or manifest or plan:
+            bail(
+                "--serve takes the services to upgrade from the requests it receives, it can't be combined with other targets"
+            )
+        targets = []
+    elif fleet:
+        if target or manifest:
+            bail("--select and --select-image can't be combined with --target or --manifest")
+        if not new_image:
+            bail("--select and --select-image need the --new-image to upgrade the services to")
+        targets = []  # found in each environment, once it's been looked up
+    elif len(environment) > 1:
+        bail("--environment can only be given multiple times with --select or --select-image")
+    elif manifest:
+        try:
+            targets = load_manifest(manifest)
+        except (IOError, ValueError) as e:
+            bail("Unable to read the manifest: %s" % e)
+    elif target:
+        targets = [parse_target(item, new_image) for item in target]
+    elif stack is not None and service is not None:
+        targets = [new_target(stack, service, new_image)]
+    else:
+        bail("Missing option '--stack' and '--service' (or '--target' or '--manifest')")
+
+    for item in targets:
+        item["stack"] = item["stack"].replace(".", "-")
+        item["service"] = item["service"].replace(".", "-")
+
+    lookup_cache = None
+
+    if cache_dir:
+        lookup_cache = LookupCache(cache_dir, rancher_url, rancher_key, cache_ttl)
+    elif serve:
+        lookup_cache = MemoryCache(cache_ttl)
+
+    if plan:
+        from rancher_gitlab_deploy.plan import Snapshot
+        from rancher_gitlab_deploy.plan import SnapshotClient
+        from rancher_gitlab_deploy.plan import plan_target
+
+    recorder = None
+    if record:
+        import atexit
+
+        from rancher_gitlab_deploy.transport import Recorder
+
+        try:
+            recorder = Recorder(record, rancher_url)
+        except (IOError, OSError) as e:
+            bail("Unable to write the recording: %s" % e)
+        atexit.register(recorder.close)
+
+    # 0 -> Authenticate all future requests, with ssl_verify based on --ssl-verify/--no-ssl-verify option
+    try:
+        if snapshot:
+            try:
+                client = SnapshotClient(Snapshot.load(snapshot))
+            except (IOError, ValueError, KeyError) as e:
+                bail("Unable to read the snapshot: %s" % e)
+        else:
+            client = RancherClient(
+                rancher_url,
+                rancher_key,
+                rancher_secret,
+                ssl_verify=ssl_verify,
+                connect_timeout=connect_timeout,
+                read_timeout=read_timeout,
+                retries=retries,
+                pool_size=parallel if fleet or serve else min(parallel, len(targets)),
+                cache=lookup_cache,
+                timings=Timings(max_entries=10000) if serve else None,
+                recorder=recorder,
+                replay=replay,
+            )
+    except DeployError as e:
+        bail(str(e))
+
+    timings = client.timings
 
     # Check for labels and environment variables to set
     defined_labels = {}
@@ -276,327 +651,242 @@ def main(
         for item in secret:
             defined_secrets.append({"type": "secretReference", "name": item})
 
-    # 1 -> Find the environment id in Rancher
-    try:
-        r = session.get("%s/projects?limit=1000" % api)
-        r.raise_for_status()
-    except HTTPError:
-        bail("Unable to connect to Rancher at %s - is the URL and API key right?" % host)
-    else:
-        environments = r.json()["data"]
+    # the services created by a deploy of several targets are found through one index of the environment
+    indexed = create and len(targets) > 1 and not fleet and not plan and not serve
 
-    environment_id = None
-    if environment is None:
-        environment_id = environments[0]["id"]
-        environment_name = environments[0]["name"]
-    else:
-        for e in environments:
-            if e["id"].lower() == environment.lower() or e["name"].lower() == environment.lower():
-                environment_id = e["id"]
-                environment_name = e["name"]
+    def write_reports(results):
+        if report_file:
+            timings.write_json(report_file, results)
 
-    if not environment_id:
-        if environment:
-            bail(
-                "The '%s' environment doesn't exist in Rancher, or your API credentials don't have access to it"
-                % environment
-            )
-        else:
-            bail("No environment in Rancher matches your request")
+        if junit_file:
+            timings.write_junit(junit_file, results, FAILED)
 
-    # map secrets to id (checking if passed secrets are defined in the environment)
-    for def_secret in defined_secrets:
-        # try to retrieve secret by name
-        try:
-            r = session.get("%s/projects/%s/secrets?name=%s" % (apiv2, environment_id, def_secret["name"]))
-            r.raise_for_status()
-        except HTTPError:
-            bail(
-                "Unable to connect to Rancher at %s to secret id for %s - are the URL and API key right? does %s exist ?"
-                % host,
-                def_secret["name"],
-                def_secret["name"],
-            )
-        else:
-            result = r.json()["data"]
-            if debug:
-                msg("secret query result: %s" % result)
-            if len(result) > 0:
-                def_secret["secretId"] = result[0]["id"]
-            else:
-                bail("Cannot find secret %s in environment %s ?!" % (def_secret["name"], environment_id))
+        if metrics_file or metrics_push_url:
+            write_metrics_reports(timings.summary(results), metrics_file, metrics_push_url)
 
-    # 2 -> Find the stack in the environment
+    def lookup_failed(message):
+        # a slow or failing lookup is what the reports are there to explain, so they're written anyway
+        write_reports(failed_results(targets, environment, message, time.monotonic() - timings.started))
+        bail(message)
 
     try:
-        r = session.get("%s/projects/%s/environments?limit=1000" % (api, environment_id))
-        r.raise_for_status()
-    except HTTPError:
-        bail("Unable to fetch a list of stacks in the environment '%s'" % environment_name)
-    else:
-        stacks = r.json()["data"]
+        # 1 -> Find the environment id in Rancher
+        timings.phase("", "environment lookup")
+        environments = [client.find_environment(name) for name in environment or [None]]
+        found = environments[0]
+
+        if plan:
+            if not snapshot:
+                # one listing of each environment, the plan is computed from it without more requests
+                timings.phase("", "snapshot")
+                client = SnapshotClient(Snapshot.take(client, environments), timings)
+            if save_snapshot:
+                client.snapshot.save(save_snapshot)
+
+        # map secrets to id (checking if passed secrets are defined in the environment)
+        if defined_secrets:
+            timings.phase("", "secret resolution")
+            secret_ids = client.find_secrets(found, [def_secret["name"] for def_secret in defined_secrets])
+
+            for def_secret in defined_secrets:
+                def_secret["secretId"] = secret_ids[def_secret["name"]]
+
+        if fleet:
+            # one listing of each environment, instead of looking up every service on its own
+            timings.phase("", "discovery")
+            selectors = [parse_selector(item) for item in select]
+            targets = interleave([discover(client, item, selectors, set(select_image), new_image) for item in environments])
+
+        if indexed:
+            # one listing of the environment answers the lookups of every target, instead of two listings each
+            timings.phase("", "discovery")
+            client.index_environment(found)
+    except DeployError as e:
+        lookup_failed(str(e))
+    except ValueError as e:
+        # a collection cut short, when Rancher or a proxy closes the connection midway
+        lookup_failed("Unable to read the answer of the Rancher API: %s" % e)
+
+    timings.phase("", None)
+
+    if fleet and not targets:
+        msg("No service in %s matches the selection" % ", ".join(item["name"] for item in environments))
+        sys.exit(0)
+
+    if events and wait_for_upgrade_to_finish and not plan:
+        try:
+            for item in environments:
+                client.subscribe(item, ssl_verify)
+        except Exception as e:
+            warn("Unable to subscribe to the Rancher event stream, polling for the service state instead (%s)" % e)
+
+    options = {
+        "batch_size": batch_size,
+        "batch_interval": batch_interval,
+        "rollout_time": rollout_time,
+        "min_healthy": min_healthy,
+        "start_before_stopping": start_before_stopping,
+        "upgrade_timeout": upgrade_timeout,
+        "poll_interval": poll_interval,
+        "poll_max_interval": poll_max_interval,
+        "wait_for_upgrade_to_finish": wait_for_upgrade_to_finish,
+        "watch_containers": watch_containers,
+        "max_restarts": max_restarts,
+        "rollback_on_error": rollback_on_error,
+        "canary": canary,
+        "canary_wait": canary_wait,
+        "canary_probe_url": canary_probe_url,
+        "pre_pull": pre_pull,
+        "lock": lock,
+        "lock_dir": lock_dir,
+        "lock_order": lock_order or time.time(),
+        "lock_timeout": lock_timeout,
+        "finish_upgrade": finish_upgrade,
+        "skip_unchanged": skip_unchanged,
+        "sidekicks": sidekicks,
+        "new_sidekick_image": dict(new_sidekick_image),
+        "create": create,
+        "labels": defined_labels,
+        "environment": defined_environment_variables,
+        "secrets": defined_secrets,
+        "service_links": service_links,
+        "service_link": service_link,
+        "host_id": host_id,
+    }
+
+    log = ClickLog()
+
+    if serve:
+        from rancher_gitlab_deploy.server import DeployAgent
+        from rancher_gitlab_deploy.server import serve as serve_deploys
+
+        serve_deploys(DeployAgent(client, found, options, parallel, log), serve, serve_token)
+        sys.exit(0)
+
+    # each environment starts at most --environment-rate upgrades a minute
+    limits = dict((item["id"], RateLimit(environment_rate)) for item in environments)
+
+    run_options = options
+    if indexed:
+        # the services created are linked once they all exist, as they may link to each other
+        run_options = dict(options, service_links=None, service_link=())
 
-    for s in stacks:
-        if s["name"].lower() == stack.lower():
-            stack = s
-            break
+    def run(item):
+        if fleet:
+            limits[item["environment"]["id"]].wait()
+        return run_target(client, found, item, run_options, log)
+
+    if plan:
+        results = [plan_target(client, found, item, options) for item in targets]
+        for result in results:
+            show_plan(result)
+
+        if len(results) > 1:
+            report(results)
+    elif len(targets) == 1:
+        results = [run_target(client, found, targets[0], options, log, prefix="")]
     else:
-        if create:
-            new_stack = {"name": stack.lower()}
-            try:
-                msg("Creating stack %s in environment %s..." % (new_stack["name"], environment_name))
-                r = session.post("%s/projects/%s/environments" % (api, environment_id), json=new_stack)
-                r.raise_for_status()
-                stack = r.json()
-            except HTTPError:
-                bail("Unable to create missing stack")
+        if fleet:
+            msg(
+                "Upgrading %d services in %s, %d at a time..."
+                % (len(targets), ", ".join(item["name"] for item in environments), parallel)
+            )
         else:
-            bail("Unable to find a stack called '%s'. Does it exist in the '%s' environment?" % (stack, environment_name))
+            msg("Upgrading %d services in environment %s, %d at a time..." % (len(targets), found["name"], parallel))
 
-    # 3 -> Find the service in the stack
+        results = run_in_order(targets, parallel, run, log)
+        if run_options is not options:
+            link_created(client, found, targets, results, options, parallel, log)
 
-    try:
-        r = session.get("%s/projects/%s/environments/%s/services?limit=1000" % (api, environment_id, stack["id"]))
-        r.raise_for_status()
-    except HTTPError:
-        bail("Unable to fetch a list of services in the stack. Does your API key have the right permissions?")
-    else:
-        services = r.json()["data"]
+        report(results)
 
-    for s in services:
-        if s["name"].lower() == service.lower():
-            service = s
-            break
-    else:
+    write_reports(results)
 
-        if create:
-            new_service = {
-                "name": service.lower(),
-                "stackId": stack["id"],
-                "startOnCreate": True,
-                "launchConfig": {
-                    "imageUuid": ("docker:%s" % new_image),
-                    "labels": defined_labels,
-                    "environment": defined_environment_variables,
-                    "secrets": defined_secrets,
-                },
-            }
-
-            if host_id is not None:
-                msg("Scheduled host %s" % host_id)
-                new_service["launchConfig"]["requestedHostId"] = host_id
+    if replay and replay.misses:
+        warn("%d requests of the deploy weren't in the recording, they were answered with a 404" % replay.misses)
 
-            try:
-                msg(
-                    "Creating service %s in environment %s with image %s..."
-                    % (new_service["name"], environment_name, new_image)
-                )
-                r = session.post("%s/projects/%s/services" % (apiv2, environment_id), json=new_service)
-                r.raise_for_status()
-                service = r.json()
-
-                defined_service_links = []
-
-                if service_links is not None:
-                    service_links_as_array = service_links.split(",")
-
-                    for service_link_item in service_links_as_array:
-                        name, reference = service_link_item.split("=", 1)
-                        serviceId = None
-
-                        for s in services:
-                            if s["name"].lower() == reference.lower():
-                                serviceId = s["id"]
-                                break
-
-                        if serviceId:
-                            defined_service_links.append({"name": name, "serviceId": serviceId})
-
-                if service_link:
-                    for name, reference in service_link:
-                        serviceId = None
-
-                        for s in services:
-                            if s["name"].lower() == reference.lower():
-                                serviceId = s["id"]
-                                break
-
-                        if serviceId:
-                            defined_service_links.append({"name": name, "serviceId": serviceId})
-
-                if defined_service_links:
-                    msg(
-                        "Setting service links for service %s in environment %s with image %s..."
-                        % (new_service["name"], environment_name, new_image)
-                    )
-                    r = session.post(service["actions"]["setservicelinks"], json={"serviceLinks": defined_service_links})
-                    r.raise_for_status()
-                    service = r.json()
-                    msg("Service links set")
-
-                msg("Creation finished")
-                sys.exit(0)
-            except HTTPError:
-                bail("Unable to create missing service")
-        else:
-            bail("Unable to find a service called '%s', does it exist in Rancher?" % service)
+    if any(result["status"] in FAILED for result in results):
+        sys.exit(1)
+
+    sys.exit(0)
 
-    # 4 -> Is the service elligible for upgrade?
 
-    if service["state"] == "upgraded":
-        warn(
-            "The current service state is 'upgraded', marking the previous upgrade as finished before starting a new upgrade..."
-        )
+class ClickLog(Log):
+    """Prints the progress of the deploy on the terminal"""
 
-        try:
-            r = session.post("%s/projects/%s/services/%s/?action=finishupgrade" % (api, environment_id, service["id"]))
-            r.raise_for_status()
-        except HTTPError:
-            bail("Unable to finish the previous upgrade in Rancher")
-
-        attempts = 0
-        while service["state"] != "active":
-            time.sleep(2)
-            attempts += 2
-            if attempts > upgrade_timeout:
-                bail("A timeout occured while waiting for Rancher to finish the previous upgrade")
-            try:
-                r = session.get("%s/projects/%s/services/%s" % (api, environment_id, service["id"]))
-                r.raise_for_status()
-            except HTTPError:
-                bail("Unable to request the service status from the Rancher API")
-            else:
-                service = r.json()
-
-    if service["state"] != "active":
-        bail("Unable to start upgrade: current service state '%s', but it needs to be 'active'" % service["state"])
-
-    msg("Upgrading %s/%s in environment %s..." % (stack["name"], service["name"], environment_name))
-
-    upgrade = {
-        "inServiceStrategy": {
-            "batchSize": batch_size,
-            "intervalMillis": batch_interval * 1000,  # rancher expects miliseconds
-            "startFirst": start_before_stopping,
-            "launchConfig": {},
-            "secondaryLaunchConfigs": [],
-        }
-    }
-    # copy over the existing config
-    upgrade["inServiceStrategy"]["launchConfig"] = service["launchConfig"]
+    def msg(self, message):
+        msg(self.prefix + message)
 
-    if defined_labels:
-        upgrade["inServiceStrategy"]["launchConfig"]["labels"] = defined_labels
+    def warn(self, message):
+        warn(self.prefix + message)
 
-    if defined_environment_variables:
-        upgrade["inServiceStrategy"]["launchConfig"]["environment"] = defined_environment_variables
+    def error(self, message):
+        bail(self.prefix + message, exit=False)
 
-    # new_sidekick_image parameter needs secondaryLaunchConfigs loaded
-    if sidekicks or new_sidekick_image:
-        # copy over existing sidekicks config
-        upgrade["inServiceStrategy"]["secondaryLaunchConfigs"] = service["secondaryLaunchConfigs"]
 
-    if new_image:
-        # place new image into config
-        upgrade["inServiceStrategy"]["launchConfig"]["imageUuid"] = "docker:%s" % new_image
+def parse_target(value, default_image):
+    """Splits a --target value of the form stack/service[=image]"""
+    name, _, image = value.partition("=")
 
-    if new_sidekick_image:
-        new_sidekick_image = dict(new_sidekick_image)
+    if name.count("/") != 1:
+        bail("The target '%s' doesn't look right, it should be stack/service or stack/service=image" % value)
 
-        for idx, secondaryLaunchConfigs in enumerate(service["secondaryLaunchConfigs"]):
-            if secondaryLaunchConfigs["name"] in new_sidekick_image:
-                upgrade["inServiceStrategy"]["secondaryLaunchConfigs"][idx]["imageUuid"] = (
-                    "docker:%s" % new_sidekick_image[secondaryLaunchConfigs["name"]]
-                )
+    stack, service = name.split("/")
+    return new_target(stack, service, image or default_image)
 
-    # 5 -> Start the upgrade
 
-    try:
-        r = session.post("%s/projects/%s/services/%s/?action=upgrade" % (api, environment_id, service["id"]), json=upgrade)
-        r.raise_for_status()
-    except HTTPError:
-        bail("Unable to request an upgrade on Rancher")
+def show_plan(result):
+    """Prints what --plan found for a service: the request upgrading (or creating) it, and the changes"""
+    if result["status"] == "failed":
+        bail("[%s] %s" % (result["target"], result["message"]), exit=False)
+        return
 
-    # 6 -> Wait for the upgrade to finish
+    if result["status"] == "unchanged":
+        msg("%s is already running this configuration" % result["target"])
+        return
 
-    if not wait_for_upgrade_to_finish:
-        msg("Upgrade started")
-    else:
-        msg("Upgrade started, waiting for upgrade to complete...")
-        attempts = 0
-        while service["state"] != "upgraded":
-            time.sleep(2)
-            attempts += 2
-            if attempts > upgrade_timeout:
-                message = "A timeout occured while waiting for Rancher to complete the upgrade"
-                if rollback_on_error:
-                    bail(message, exit=False)
-                    warn("Processing image rollback...")
-
-                    try:
-                        r = session.post(
-                            "%s/projects/%s/services/%s/?action=rollback" % (api, environment_id, service["id"])
-                        )
-                        r.raise_for_status()
-                    except HTTPError:
-                        bail("Unable to request a rollback on Rancher")
-
-                    attempts = 0
-                    while service["state"] != "active":
-                        time.sleep(2)
-                        attempts += 2
-                        if attempts > upgrade_timeout:
-                            bail(
-                                "A timeout occured while waiting for Rancher to rollback the upgrade to its latest running state"
-                            )
-                        try:
-                            r = session.get("%s/projects/%s/services/%s" % (api, environment_id, service["id"]))
-                            r.raise_for_status()
-                        except HTTPError:
-                            bail("Unable to request the service status from the Rancher API")
-                        else:
-                            service = r.json()
-
-                    warn("Service sucessfully rolled back")
-                    sys.exit(1)
-                else:
-                    bail(message)
-            try:
-                r = session.get("%s/projects/%s/services/%s" % (api, environment_id, service["id"]))
-                r.raise_for_status()
-            except HTTPError:
-                bail("Unable to fetch the service status from the Rancher API")
-            else:
-                service = r.json()
-
-        if not finish_upgrade:
-            msg("Service upgraded")
-            sys.exit(0)
+    msg("%s would be %sd with:" % (result["target"], result["status"]))
+    click.echo(json.dumps(result["payload"], indent=2, sort_keys=True))
+    click.echo(result["diff"], nl=False)
+
+
+def report(results):
+    """Prints the status of every --target or --manifest service once they have all finished"""
+    width = max(len(result["target"]) for result in results)
+
+    msg("Summary:")
+    for result in results:
+        line = "  %s  %-11s %6.1fs  %s" % (
+            result["target"].ljust(width),
+            result["status"],
+            result["seconds"],
+            result["message"],
+        )
+        if result["status"] in FAILED:
+            warn(line.rstrip())
         else:
-            msg("Finishing upgrade...")
-            try:
-                r = session.post("%s/projects/%s/services/%s/?action=finishupgrade" % (api, environment_id, service["id"]))
-                r.raise_for_status()
-            except HTTPError:
-                bail("Unable to finish the upgrade in Rancher")
-
-            attempts = 0
-            while service["state"] != "active":
-                time.sleep(2)
-                attempts += 2
-                if attempts > upgrade_timeout:
-                    bail("A timeout occured while waiting for Rancher to finish the previous upgrade")
-                try:
-                    r = session.get("%s/projects/%s/services/%s" % (api, environment_id, service["id"]))
-                    r.raise_for_status()
-                except HTTPError:
-                    bail("Unable to request the service status from the Rancher API")
-                else:
-                    service = r.json()
-
-            msg("Upgrade finished")
+            msg(line.rstrip())
 
-    sys.exit(0)
+
+def failed_results(targets, environments, message, seconds):
+    """The results of a deploy that failed before upgrading anything, by environment if no target was found yet"""
+    names = [display_name(item) for item in targets] or list(environments) or ["default environment"]
+    return [{"target": name, "status": "failed", "seconds": seconds, "message": message} for name in names]
+
+
+def write_metrics_reports(summary, path, push_url):
+    from rancher_gitlab_deploy.metrics import push_metrics
+    from rancher_gitlab_deploy.metrics import write_metrics
+
+    if path:
+        write_metrics(path, summary)
+
+    if push_url:
+        try:
+            push_metrics(push_url, summary)
+        except Exception as e:
+            # the deploy is done, not being able to report on it isn't worth failing the job
+            warn("Unable to push the metrics to %s: %s" % (push_url, e))
 
 
 def msg(message):
@@ -615,6 +905,13 @@ def bail(message, exit=True):
 
 def debug_requests_on():
     """Switches on logging of the requests module."""
+    import logging
+
+    try:
+        from httplib import HTTPConnection  # py2
+    except ImportError:
+        from http.client import HTTPConnection  # py3
+
     HTTPConnection.debuglevel = 1
 
     logging.basicConfig()
@@ -0,0 +1,628 @@
+import functools
+import random
+import threading
+import time
+
+from requests import RequestException
+
+from rancher_gitlab_deploy.stream import CHUNK_SIZE
+from rancher_gitlab_deploy.stream import CollectionStream
+from rancher_gitlab_deploy.timings import Timings
+from rancher_gitlab_deploy.transport import new_session
+
+# growth factor of the interval between two polls of the service state
+POLL_BACKOFF = 1.5
+
+# the fields kept from the listings of environments, stacks and secrets
+NAME_FIELDS = ("id", "name")
+
+# the fields kept from the listings of every service of an environment, the ones discovery and plans need
+SERVICE_FIELDS = ("id", "name", "state", "stackId", "accountId", "scale", "launchConfig", "secondaryLaunchConfigs")
+
+# the fields kept in the index of an environment, the services found through it are fetched again
+INDEX_FIELDS = ("id", "name", "stackId")
+
+
+class DeployError(Exception):
+    """An upgrade step failed, the message explains which one"""
+
+
+class WaitTimeout(DeployError):
+    """Rancher didn't put the service in the expected state before the timeout"""
+
+
+class ContainerFailed(DeployError):
+    """One of the containers started by the upgrade failed, so there's no point waiting for the rest"""
+
+
+class HealthCheckFailed(ContainerFailed):
+    """The new containers are running, but the health probe of a canary upgrade failed"""
+
+
+class RolledBack(DeployError):
+    """The upgrade failed but the service was rolled back to its previous state"""
+
+
+class EnvironmentIndex(object):
+    """The stacks and services of an environment by name, from one listing of each
+
+    Lookups are answered from it instead of asking Rancher for every service, and the stacks and
+    services created through the client are added to it, so the services created by one deploy can
+    be found (and linked to) by the others.
+    """
+
+    def __init__(self, stacks, services):
+        self.lock = threading.Lock()
+        self.stacks = dict((stack["name"].lower(), stack) for stack in stacks)
+        self.services = {}
+        for service in services:
+            self.add_service(service)
+
+    def stack(self, name):
+        return self.stacks.get(name.lower())
+
+    def add_stack(self, stack):
+        self.stacks[stack["name"].lower()] = stack
+
+    def stack_services(self, stack):
+        return list(self.services.get(stack["id"], {}).values())
+
+    def service(self, stack, name):
+        return self.services.get(stack["id"], {}).get(name.lower())
+
+    def add_service(self, service):
+        service = dict((key, service[key]) for key in INDEX_FIELDS)
+        self.services.setdefault(service["stackId"], {})[service["name"].lower()] = service
+
+
+class RancherClient(object):
+    """Finds, upgrades and waits for services through the Rancher API
+
+    Environments, stacks and services are the dicts returned by the API. Every method raises DeployError
+    (or one of its subclasses) when Rancher can't do what was asked. One client can be shared by threads
+    upgrading different services, they share its connection pool.
+    """
+
+    def __init__(
+        self,
+        url,
+        access_key,
+        secret_key,
+        ssl_verify=True,
+        connect_timeout=10,
+        read_timeout=60,
+        retries=3,
+        pool_size=1,
+        cache=None,
+        timings=None,
+        recorder=None,
+        replay=None,
+    ):
+        # split url to protocol and host
+        if "://" not in url:
+            raise DeployError("The Rancher URL doesn't look right")
+
+        proto, self.host = url.split("://")
+        self.api = "%s://%s/v1" % (proto, self.host)
+        self.apiv2 = "%s://%s/v2-beta" % (proto, self.host)
+
+        self.session = new_session(
+            (access_key, secret_key),
+            ssl_verify=ssl_verify,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            retries=retries,
+            pool_size=pool_size,
+            recorder=recorder,
+            replay=replay,
+        )
+
+        self.cache = cache
+        self.timings = timings or Timings()
+        self.session.hooks["response"].append(self.timings.on_response)
+
+        # the event stream of each environment subscribed to, by environment id
+        self.events = {}
+        # the name each environment was looked up with, to forget it from the cache if it's gone
+        self.environment_lookups = {}
+        # the ids of the environments found in the lookup cache, which may not exist anymore
+        self.cached_environments = set()
+        self.environment_lock = threading.Lock()
+        # the EnvironmentIndex of each environment indexed, by environment id
+        self.indexes = {}
+
+    def list_resources(self, url, params=None, fields=None):
+        """Yields every resource in the collection at url, following Rancher's pagination links
+
+        Each page is parsed while it's downloaded, keeping only the fields of the resources listed in
+        fields (all of them by default), instead of decoding the whole page at once.
+        """
+        params = dict(params or {}, limit=1000)
+
+        while url:
+            started = time.monotonic()
+            r = self.session.get(url, params=params, stream=True)
+            try:
+                r.raise_for_status()
+                collection = CollectionStream(r.iter_content(CHUNK_SIZE), fields)
+                # the whole page is read before yielding, so the connection goes back to the pool
+                resources = list(collection)
+            finally:
+                r.close()
+            self.timings.record(r, collection.bytes_read, time.monotonic() - started)
+
+            for resource in resources:
+                yield resource
+
+            # the next link already carries the filters and the marker of the next page
+            url = (collection.document.get("pagination") or {}).get("next")
+            params = None
+
+    def find_by_name(self, url, name, match_id=False, fields=None):
+        """Returns the resource called name in the collection at url, or None if there isn't one
+
+        Rancher is asked to filter the collection by name first, so only the matching resource is sent
+        back. Names are compared case insensitively, so if that finds nothing the whole collection is
+        paged through.
+        """
+
+        def matches(resource):
+            return resource["name"].lower() == name.lower() or (match_id and resource["id"].lower() == name.lower())
+
+        filters = [{"name": name}, {"id": name}] if match_id else [{"name": name}]
+
+        # the filtered results are checked as well, in case this Rancher version ignores a filter
+        for params in filters + [None]:
+            for resource in self.list_resources(url, params, fields):
+                if matches(resource):
+                    return resource
+
+        return None
+
+    def find_environment(self, name=None):
+        """Returns the environment with this name or id, or the first one the API key has access to"""
+        cached = self.cache.get("environment", name or "") if self.cache else None
+
+        if cached:
+            environment = {"id": cached[0], "name": cached[1]}
+            self.cached_environments.add(environment["id"])
+        else:
+            try:
+                if name is None:
+                    r = self.session.get("%s/projects" % self.api, params={"limit": 1})
+                    r.raise_for_status()
+                    environment = (r.json()["data"] or [None])[0]
+                else:
+                    environment = self.find_by_name("%s/projects" % self.api, name, match_id=True, fields=NAME_FIELDS)
+            except RequestException:
+                raise DeployError("Unable to connect to Rancher at %s - is the URL and API key right?" % self.host)
+
+            if environment is None:
+                if name:
+                    raise DeployError(
+                        "The '%s' environment doesn't exist in Rancher, or your API credentials don't have access to it"
+                        % name
+                    )
+                raise DeployError("No environment in Rancher matches your request")
+
+            environment = {"id": environment["id"], "name": environment["name"]}
+            if self.cache:
+                self.cache.set([environment["id"], environment["name"]], "environment", name or "")
+
+        self.environment_lookups[environment["id"]] = name or ""
+        return environment
+
+    def refresh_environment(self, environment, environment_id, e):
+        """Whether a request about the environment that failed with e should be retried with it
+
+        It should if the id remembered in the lookup cache is gone: the environment is looked up again,
+        and updated in place for every deploy sharing it.
+        """
+        if e.response is None or e.response.status_code != 404:
+            return False
+
+        with self.environment_lock:
+            if environment["id"] != environment_id:
+                # another deploy found it again in the meantime
+                return True
+            if environment_id not in self.cached_environments:
+                return False
+
+            self.cached_environments.discard(environment_id)
+            name = self.environment_lookups.get(environment_id, "")
+            self.cache.invalidate("environment", name)
+            environment.update(self.find_environment(name or None))
+            return True
+
+    def list_secrets(self, environment):
+        environment_id = environment["id"]
+        try:
+            return list(self.list_resources("%s/projects/%s/secrets" % (self.apiv2, environment["id"]), fields=NAME_FIELDS))
+        except RequestException as e:
+            if self.refresh_environment(environment, environment_id, e):
+                return self.list_secrets(environment)
+            raise DeployError(
+                "Unable to connect to Rancher at %s to fetch the secrets in environment %s - are the URL and API key right?"
+                % (self.host, environment["name"])
+            )
+
+    def find_secrets(self, environment, names):
+        """Maps secret names to their ids, with one listing of the environment's secrets"""
+        secret_ids = dict((s["name"], s["id"]) for s in self.list_secrets(environment))
+
+        missing = [name for name in names if name not in secret_ids]
+        if missing:
+            raise DeployError("Cannot find secret(s) %s in environment %s ?!" % (", ".join(missing), environment["name"]))
+
+        return dict((name, secret_ids[name]) for name in names)
+
+    def index_environment(self, environment):
+        """Lists the stacks and services of the environment once, to answer the lookups in it from then on"""
+        index = EnvironmentIndex(self.list_stacks(environment), self.list_environment_services(environment, INDEX_FIELDS))
+        self.indexes[environment["id"]] = index
+        return index
+
+    def find_stack(self, environment, name):
+        """Returns the stack with this name in the environment, or None"""
+        index = self.indexes.get(environment["id"])
+        if index is not None:
+            return index.stack(name)
+
+        environment_id = environment["id"]
+        try:
+            return self.find_by_name("%s/projects/%s/environments" % (self.api, environment["id"]), name, fields=NAME_FIELDS)
+        except RequestException as e:
+            if self.refresh_environment(environment, environment_id, e):
+                return self.find_stack(environment, name)
+            raise DeployError("Unable to fetch a list of stacks in the environment '%s'" % environment["name"])
+
+    def create_stack(self, environment, name, creating=None):
+        """Creates the stack, calling creating() first if this call is the one creating it"""
+        index = self.indexes.get(environment["id"])
+        if index is None:
+            return self.post_stack(environment, name, creating)
+
+        # deploys creating services in the same missing stack create it once
+        with index.lock:
+            stack = index.stack(name)
+            if stack is None:
+                stack = self.post_stack(environment, name, creating)
+                index.add_stack(stack)
+        return stack
+
+    def post_stack(self, environment, name, creating=None):
+        if creating is not None:
+            creating()
+
+        try:
+            r = self.session.post("%s/projects/%s/environments" % (self.api, environment["id"]), json={"name": name})
+            r.raise_for_status()
+        except RequestException:
+            raise DeployError("Unable to create missing stack")
+
+        return r.json()
+
+    def list_stacks(self, environment):
+        environment_id = environment["id"]
+        try:
+            url = "%s/projects/%s/environments" % (self.api, environment["id"])
+            return list(self.list_resources(url, fields=NAME_FIELDS))
+        except RequestException as e:
+            if self.refresh_environment(environment, environment_id, e):
+                return self.list_stacks(environment)
+            raise DeployError("Unable to fetch a list of stacks in the environment '%s'" % environment["name"])
+
+    def list_environment_services(self, environment, fields=SERVICE_FIELDS):
+        """Returns every service of every stack in the environment, with one paged listing, keeping only fields"""
+        environment_id = environment["id"]
+        try:
+            url = "%s/projects/%s/services" % (self.api, environment["id"])
+            return list(self.list_resources(url, fields=fields))
+        except RequestException as e:
+            if self.refresh_environment(environment, environment_id, e):
+                return self.list_environment_services(environment, fields)
+            raise DeployError(
+                "Unable to fetch a list of services in the environment '%s'. Does your API key have the right permissions?"
+                % environment["name"]
+            )
+
+    def stack_services_url(self, environment, stack):
+        return "%s/projects/%s/environments/%s/services" % (self.api, environment["id"], stack["id"])
+
+    def find_service(self, environment, stack, name):
+        """Returns the service with this name in the stack, or None"""
+        index = self.indexes.get(environment["id"])
+        if index is not None:
+            found = index.service(stack, name)
+            # the listing may be minutes old by now, the state has to be the current one
+            return self.get_service(environment, found) if found is not None else None
+
+        try:
+            return self.find_by_name(self.stack_services_url(environment, stack), name)
+        except RequestException:
+            raise DeployError(
+                "Unable to fetch a list of services in the stack. Does your API key have the right permissions?"
+            )
+
+    def list_services(self, environment, stack):
+        index = self.indexes.get(environment["id"])
+        if index is not None:
+            return index.stack_services(stack)
+
+        try:
+            return list(self.list_resources(self.stack_services_url(environment, stack)))
+        except RequestException:
+            raise DeployError(
+                "Unable to fetch a list of services in the stack. Does your API key have the right permissions?"
+            )
+
+    def cached_service(self, environment, stack_name, service_name):
+        """Returns the (stack, service) remembered for these names in the lookup cache, or None
+
+        This skips the stack and service listings, fetching the service upgraded last time directly.
+        """
+        cached = self.cache.get("service", environment["id"], stack_name, service_name) if self.cache else None
+        if cached is None:
+            return None
+
+        self.timings.phase("%s/%s" % (stack_name, service_name), "service lookup")
+        try:
+            r = self.session.get("%s/projects/%s/services/%s" % (self.api, environment["id"], cached["service"]))
+            if r.status_code == 404 or (r.ok and r.json()["name"].lower() != service_name.lower()):
+                self.cache.invalidate("service", environment["id"], stack_name, service_name)
+                return None
+            r.raise_for_status()
+        except RequestException:
+            raise DeployError("Unable to request the service status from the Rancher API")
+
+        return cached["stack"], r.json()
+
+    def remember_service(self, environment, stack_name, service_name, stack, service):
+        if self.cache:
+            self.cache.set(
+                {"stack": {"id": stack["id"], "name": stack["name"]}, "service": service["id"]},
+                "service",
+                environment["id"],
+                stack_name,
+                service_name,
+            )
+
+    def create_service(self, environment, service):
+        try:
+            r = self.session.post("%s/projects/%s/services" % (self.apiv2, environment["id"]), json=service)
+            r.raise_for_status()
+        except RequestException:
+            raise DeployError("Unable to create missing service")
+
+        service = r.json()
+        index = self.indexes.get(environment["id"])
+        if index is not None:
+            with index.lock:
+                index.add_service(service)
+        return service
+
+    def set_service_links(self, service, links):
+        try:
+            r = self.session.post(service["actions"]["setservicelinks"], json={"serviceLinks": links})
+            r.raise_for_status()
+        except RequestException:
+            raise DeployError("Unable to create missing service")
+
+        return r.json()
+
+    def service_url(self, environment, service):
+        return "%s/projects/%s/services/%s" % (self.api, environment["id"], service["id"])
+
+    def get_service(self, environment, service):
+        try:
+            r = self.session.get(self.service_url(environment, service))
+            r.raise_for_status()
+        except RequestException:
+            raise DeployError("Unable to request the service status from the Rancher API")
+
+        return r.json()
+
+    def pull_image(self, environment, image):
+        """Starts pulling the image on the hosts that already have a version of it, returns the pull task"""
+        try:
+            r = self.session.post(
+                "%s/projects/%s/pulltasks" % (self.apiv2, environment["id"]), json={"image": image, "mode": "existing"}
+            )
+            r.raise_for_status()
+        except RequestException:
+            raise DeployError("Unable to start pulling %s in Rancher" % image)
+
+        return r.json()
+
+    def get_pull_task(self, environment, task):
+        try:
+            r = self.session.get("%s/projects/%s/pulltasks/%s" % (self.apiv2, environment["id"], task["id"]))
+            r.raise_for_status()
+        except RequestException:
+            raise DeployError("Unable to request the status of the image pull from the Rancher API")
+
+        return r.json()
+
+    def set_metadata(self, environment, service, metadata):
+        """Replaces the metadata of the service, which doesn't restart its containers"""
+        try:
+            r = self.session.put(self.service_url(environment, service), json={"metadata": metadata})
+            r.raise_for_status()
+        except RequestException:
+            raise DeployError("Unable to update the metadata of the service in Rancher")
+
+        return r.json()
+
+    def list_instances(self, environment, service):
+        """Returns the containers of the service"""
+        try:
+            return list(self.list_resources("%s/instances" % self.service_url(environment, service)))
+        except RequestException:
+            raise DeployError("Unable to fetch the containers of the service from the Rancher API")
+
+    def action(self, environment, service, action, error, payload=None):
+        try:
+            r = self.session.post("%s/?action=%s" % (self.service_url(environment, service), action), json=payload)
+            r.raise_for_status()
+        except RequestException:
+            raise DeployError(error)
+
+        return r.json()
+
+    def upgrade(self, environment, service, upgrade):
+        """Starts an in service upgrade, upgrade being the payload with the inServiceStrategy"""
+        return self.action(environment, service, "upgrade", "Unable to request an upgrade on Rancher", upgrade)
+
+    def finish_upgrade(self, environment, service, error="Unable to finish the upgrade in Rancher"):
+        return self.action(environment, service, "finishupgrade", error)
+
+    def rollback(self, environment, service):
+        return self.action(environment, service, "rollback", "Unable to request a rollback on Rancher")
+
+    def subscribe(self, environment, ssl_verify=True):
+        """Follows the environment's event stream, so wait() doesn't have to poll as often"""
+        from rancher_gitlab_deploy.events import ServiceEvents
+
+        events = ServiceEvents(self.api, environment["id"], self.session.auth, ssl_verify)
+        events.connect()
+        self.events[environment["id"]] = events
+
+    def wait(
+        self,
+        environment,
+        service,
+        state,
+        timeout,
+        timeout_message="A timeout occured while waiting for Rancher",
+        poll_interval=1.0,
+        poll_max_interval=10.0,
+        check=None,
+    ):
+        """Polls the service until Rancher reports it in the given state, backing off between polls
+
+        After subscribe(), the state changes pushed by Rancher are used between polls instead of sleeping.
+        If given, check is called with the service after every poll, and can raise to stop waiting.
+        The timeout is measured with a monotonic clock, so slow requests count towards it too.
+        """
+        deadline = time.monotonic() + timeout
+        interval = poll_interval
+
+        while True:
+            service = self.get_service(environment, service)
+            self.timings.count("polls")
+
+            if service["state"] == state:
+                return service
+
+            if check is not None:
+                check(service)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise WaitTimeout(timeout_message)
+
+            events = self.events.get(environment["id"])
+            if events is not None and not events.closed:
+                # still poll every poll_max_interval, in case an event goes missing
+                changed = events.wait(service["id"], state, min(remaining, poll_max_interval))
+                if changed is not None:
+                    return changed
+                continue
+
+            # jitter stops concurrent deploys from polling Rancher in lockstep
+            time.sleep(min(random.uniform(interval / 2, interval), remaining))
+            interval = min(interval * POLL_BACKOFF, poll_max_interval)
+
+
+class AsyncRancherClient(object):
+    """asyncio flavour of RancherClient, with the same methods as coroutines
+
+    The requests run in a thread pool of max_workers threads, sharing the connection pool of one
+    RancherClient, so the event loop is never blocked waiting on Rancher.
+    """
+
+    def __init__(self, *args, **kwargs):
+        from concurrent.futures import ThreadPoolExecutor
+
+        max_workers = kwargs.pop("max_workers", None) or 16
+        kwargs.setdefault("pool_size", max_workers)
+
+        self.client = RancherClient(*args, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def run(self, function, *args, **kwargs):
+        """Runs a blocking function in the client's thread pool"""
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.client.session.close()
+
+    async def find_environment(self, *args, **kwargs):
+        return await self.run(self.client.find_environment, *args, **kwargs)
+
+    async def find_secrets(self, *args, **kwargs):
+        return await self.run(self.client.find_secrets, *args, **kwargs)
+
+    async def list_secrets(self, *args, **kwargs):
+        return await self.run(self.client.list_secrets, *args, **kwargs)
+
+    async def index_environment(self, *args, **kwargs):
+        return await self.run(self.client.index_environment, *args, **kwargs)
+
+    async def find_stack(self, *args, **kwargs):
+        return await self.run(self.client.find_stack, *args, **kwargs)
+
+    async def create_stack(self, *args, **kwargs):
+        return await self.run(self.client.create_stack, *args, **kwargs)
+
+    async def list_stacks(self, *args, **kwargs):
+        return await self.run(self.client.list_stacks, *args, **kwargs)
+
+    async def list_environment_services(self, *args, **kwargs):
+        return await self.run(self.client.list_environment_services, *args, **kwargs)
+
+    async def find_service(self, *args, **kwargs):
+        return await self.run(self.client.find_service, *args, **kwargs)
+
+    async def list_services(self, *args, **kwargs):
+        return await self.run(self.client.list_services, *args, **kwargs)
+
+    async def create_service(self, *args, **kwargs):
+        return await self.run(self.client.create_service, *args, **kwargs)
+
+    async def set_service_links(self, *args, **kwargs):
+        return await self.run(self.client.set_service_links, *args, **kwargs)
+
+    async def get_service(self, *args, **kwargs):
+        return await self.run(self.client.get_service, *args, **kwargs)
+
+    async def pull_image(self, *args, **kwargs):
+        return await self.run(self.client.pull_image, *args, **kwargs)
+
+    async def get_pull_task(self, *args, **kwargs):
+        return await self.run(self.client.get_pull_task, *args, **kwargs)
+
+    async def set_metadata(self, *args, **kwargs):
+        return await self.run(self.client.set_metadata, *args, **kwargs)
+
+    async def list_instances(self, *args, **kwargs):
+        return await self.run(self.client.list_instances, *args, **kwargs)
+
+    async def upgrade(self, *args, **kwargs):
+        return await self.run(self.client.upgrade, *args, **kwargs)
+
+    async def finish_upgrade(self, *args, **kwargs):
+        return await self.run(self.client.finish_upgrade, *args, **kwargs)
+
+    async def rollback(self, *args, **kwargs):
+        return await self.run(self.client.rollback, *args, **kwargs)
+
+    async def subscribe(self, *args, **kwargs):
+        return await self.run(self.client.subscribe, *args, **kwargs)
+
+    async def wait(self, *args, **kwargs):
+        return await self.run(self.client.wait, *args, **kwargs)
@@ -0,0 +1,664 @@
+import copy
+import time
+
+from rancher_gitlab_deploy.client import ContainerFailed
+from rancher_gitlab_deploy.client import DeployError
+from rancher_gitlab_deploy.client import RolledBack
+from rancher_gitlab_deploy.client import WaitTimeout
+from rancher_gitlab_deploy.lock import lease_for
+from rancher_gitlab_deploy.manifest import target_name
+from rancher_gitlab_deploy.tuning import remember_batches
+from rancher_gitlab_deploy.tuning import tune_batches
+
+# statuses of a service that make the deploy fail
+FAILED = ("failed", "rolled back", "skipped")
+
+# the options of upgrade_service, with the same defaults as the command line
+DEFAULT_OPTIONS = {
+    "batch_size": 1,
+    "batch_interval": 2,
+    "start_before_stopping": False,
+    "upgrade_timeout": 5 * 60,
+    "poll_interval": 1.0,
+    "poll_max_interval": 10.0,
+    "wait_for_upgrade_to_finish": True,
+    "watch_containers": False,
+    "max_restarts": 3,
+    "rollback_on_error": False,
+    "finish_upgrade": True,
+    "skip_unchanged": False,
+    "canary": 0,
+    "canary_wait": 30,
+    "canary_probe_url": None,
+    "pre_pull": False,
+    "rollout_time": None,
+    "min_healthy": 75,
+    "lock": None,
+    "lock_dir": None,
+    "lock_order": None,
+    "lock_timeout": 30 * 60,
+    "sidekicks": False,
+    "new_sidekick_image": {},
+    "create": False,
+    "labels": {},
+    "environment": {},
+    "secrets": [],
+    "service_links": None,
+    "service_link": (),
+    "host_id": None,
+}
+
+
+class Log(object):
+    """Receives the progress messages of a deploy, this one discards them"""
+
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+
+    def for_target(self, prefix):
+        """Returns a log of the same kind, with messages prefixed by the name of a service"""
+        return type(self)(prefix)
+
+    def msg(self, message):
+        pass
+
+    def warn(self, message):
+        pass
+
+    def error(self, message):
+        pass
+
+
+def default_options(**options):
+    """Returns the options for upgrade_service, with the command line defaults for the ones not given"""
+    unknown = set(options) - set(DEFAULT_OPTIONS)
+    if unknown:
+        raise TypeError("Unknown upgrade option(s): %s" % ", ".join(sorted(unknown)))
+
+    return dict(copy.deepcopy(DEFAULT_OPTIONS), **options)
+
+
+def new_target(stack, service, image):
+    return {
+        "stack": stack,
+        "service": service,
+        "image": image,
+        "labels": {},
+        "variables": {},
+        "sidekick_images": {},
+        "depends_on": [],
+    }
+
+
+def target_options(options, target):
+    """Merges the labels, variables and sidekick images of a --manifest service over the command line ones"""
+    if not (target["labels"] or target["variables"] or target["sidekick_images"]):
+        return options
+
+    return dict(
+        options,
+        labels=dict(options["labels"], **target["labels"]),
+        environment=dict(options["environment"], **target["variables"]),
+        new_sidekick_image=dict(options["new_sidekick_image"], **target["sidekick_images"]),
+    )
+
+
+def display_name(target):
+    """stack/service, prefixed by the environment for the targets of a fleet rollout"""
+    name = "%s/%s" % (target["stack"], target["service"])
+    if "environment" in target:
+        name = "%s/%s" % (target["environment"]["name"], name)
+    return name
+
+
+def run_target(client, environment, target, options, log, prefix=None):
+    """Upgrades one of the --target, --manifest or --select services, returning a status instead of raising
+
+    Targets found by a fleet rollout carry their own environment, and the stack and service found.
+    """
+    stack, service = target["stack"], target["service"]
+    environment = target.get("environment") or environment
+    name = display_name(target)
+    if prefix is None:
+        prefix = "[%s] " % name
+    log = log.for_target(prefix)
+    started = time.monotonic()
+
+    try:
+        status = upgrade_service(
+            client,
+            environment,
+            stack,
+            service,
+            target["image"],
+            target_options(options, target),
+            log,
+            found=target.get("found"),
+            name=name,
+        )
+        message = ""
+    except RolledBack as e:
+        log.warn(str(e))
+        status, message = "rolled back", str(e)
+    except DeployError as e:
+        log.error(str(e))
+        status, message = "failed", str(e)
+    finally:
+        client.timings.phase(name, None)
+
+    return {
+        "target": name,
+        "status": status,
+        "seconds": time.monotonic() - started,
+        "message": message,
+    }
+
+
+def run_in_order(targets, parallel, run, log):
+    """Calls run for every target, at most parallel at a time, once the targets it depends on have finished
+
+    Targets that depend on one that failed are skipped. Returns the results in the order of targets.
+    """
+    from concurrent.futures import FIRST_COMPLETED
+    from concurrent.futures import ThreadPoolExecutor
+    from concurrent.futures import wait
+
+    # by position, as the services of a fleet rollout can have the same name in different environments
+    results = [None] * len(targets)
+    by_name = {}
+    pending = list(range(len(targets)))
+    running = {}
+
+    def finished(index, result):
+        results[index] = result
+        by_name[target_name(targets[index])] = result
+
+    with ThreadPoolExecutor(max_workers=max(parallel, 1)) as pool:
+        while pending or running:
+            for index in list(pending):
+                item = targets[index]
+                dependencies = [by_name.get(name.replace(".", "-").lower()) for name in item["depends_on"]]
+
+                failed = [result["target"] for result in dependencies if result and result["status"] in FAILED]
+                if failed:
+                    log.warn("[%s] Skipped, because %s failed" % (display_name(item), ", ".join(failed)))
+                    finished(
+                        index,
+                        {
+                            "target": display_name(item),
+                            "status": "skipped",
+                            "seconds": 0.0,
+                            "message": "%s failed" % ", ".join(failed),
+                        },
+                    )
+                    pending.remove(index)
+                elif all(dependencies):
+                    running[pool.submit(run, item)] = index
+                    pending.remove(index)
+
+            if not running:
+                continue  # only skipped targets changed, look at the pending ones again
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                finished(running.pop(future), future.result())
+
+    return results
+
+
+def upgrade_service(client, environment, stack, service, new_image, options, log=None, found=None, name=None):
+    """Finds (or creates) the service in the stack and performs an in service upgrade of it
+
+    found is the (stack, service) if the caller already listed them, to fetch the service directly.
+    name is what the timings of the phases are recorded under, stack/service by default.
+
+    Returns how far it went: created, superseded (by a newer deploy, with a lock), unchanged, started
+    (without waiting), upgraded (without finishing) or finished. Raises DeployError if it failed, or
+    RolledBack if it failed and was rolled back.
+    """
+    log = log or Log()
+    timings = client.timings
+    stack_name, service_name = stack, service
+    phase_key = name or "%s/%s" % (stack_name, service_name)
+
+    if found is not None:
+        # the listing may be minutes old by now, the state has to be the current one
+        timings.phase(phase_key, "service lookup")
+        found = found[0], client.get_service(environment, found[1])
+    else:
+        found = client.cached_service(environment, stack_name, service_name)
+
+    if found is not None:
+        stack, service = found
+    else:
+        # 2 -> Find the stack in the environment
+        timings.phase(phase_key, "stack lookup")
+        stack = client.find_stack(environment, stack_name)
+
+        if stack is None:
+            if not options["create"]:
+                raise DeployError(
+                    "Unable to find a stack called '%s'. Does it exist in the '%s' environment?"
+                    % (stack_name, environment["name"])
+                )
+
+            message = "Creating stack %s in environment %s..." % (stack_name.lower(), environment["name"])
+            stack = client.create_stack(environment, stack_name.lower(), lambda: log.msg(message))
+
+        # 3 -> Find the service in the stack
+        timings.phase(phase_key, "service lookup")
+        service = client.find_service(environment, stack, service_name)
+
+        if service is None:
+            if not options["create"]:
+                raise DeployError("Unable to find a service called '%s', does it exist in Rancher?" % service_name)
+
+            timings.phase(phase_key, "create")
+            create_service(client, environment, stack, service_name, new_image, options, log)
+            return "created"
+
+        client.remember_service(environment, stack_name, service_name, stack, service)
+
+    if not options["lock"]:
+        return start_upgrade(client, environment, stack, service, new_image, options, log, phase_key)
+
+    # 4 -> Wait for the deploys of the service that started before this one
+    timings.phase(phase_key, "wait for lock")
+    lease = lease_for(client, environment, stack, service, new_image, options)
+    if not lease.acquire(options["lock_timeout"], options["poll_interval"], log):
+        log.msg("A newer deploy of %s/%s is queued or done, skipping this one" % (stack["name"], service["name"]))
+        return "superseded"
+
+    succeeded = False
+    try:
+        # the deploy that held the lock changed the service
+        service = client.get_service(environment, service)
+        status = start_upgrade(client, environment, stack, service, new_image, options, log, phase_key)
+        succeeded = True
+        return status
+    finally:
+        lease.release(succeeded)
+
+
+def start_upgrade(client, environment, stack, service, new_image, options, log, phase_key):
+    """The upgrade part of upgrade_service, once the service has been found"""
+    timings = client.timings
+    wait_options = {"poll_interval": options["poll_interval"], "poll_max_interval": options["poll_max_interval"]}
+
+    # 5 -> Is the service elligible for upgrade?
+
+    if service["state"] == "upgraded":
+        timings.phase(phase_key, "finish previous upgrade")
+        log.warn(
+            "The current service state is 'upgraded', marking the previous upgrade as finished before starting a new upgrade..."
+        )
+
+        client.finish_upgrade(environment, service, "Unable to finish the previous upgrade in Rancher")
+        service = client.wait(
+            environment,
+            service,
+            "active",
+            options["upgrade_timeout"],
+            "A timeout occured while waiting for Rancher to finish the previous upgrade",
+            **wait_options,
+        )
+
+    if service["state"] != "active":
+        raise DeployError(
+            "Unable to start upgrade: current service state '%s', but it needs to be 'active'" % service["state"]
+        )
+
+    containers = service.get("scale")
+    if options["rollout_time"]:
+        options, containers = tune_batches(client, environment, service, options, log)
+
+    upgrade = build_upgrade(service, new_image, options)
+
+    changes = config_changes(service, upgrade) if options["skip_unchanged"] else None
+    if changes == []:
+        log.msg("%s/%s is already running this configuration, skipping the upgrade" % (stack["name"], service["name"]))
+        return "unchanged"
+
+    log.msg("Upgrading %s/%s in environment %s..." % (stack["name"], service["name"], environment["name"]))
+
+    for change in changes or []:
+        log.msg("  " + change)
+
+    if options["pre_pull"]:
+        timings.phase(phase_key, "pre-pull")
+        pre_pull(client, environment, service, upgrade, options, log)
+
+    # 6 -> Start the upgrade
+    timings.phase(phase_key, "upgrade request")
+
+    check = None
+    if options["watch_containers"] and options["wait_for_upgrade_to_finish"]:
+        check = container_check(client, environment, service, options, log)
+
+    canary = None
+    if options["canary"] and options["wait_for_upgrade_to_finish"]:
+        # imported here, as it imports this module
+        from rancher_gitlab_deploy.canary import Canary
+
+        canary = Canary(client, environment, service, options, log)
+
+    client.upgrade(environment, service, upgrade)
+    started = time.monotonic()
+
+    # 7 -> Wait for the upgrade to finish
+
+    if not options["wait_for_upgrade_to_finish"]:
+        log.msg("Upgrade started")
+        return "started"
+
+    log.msg("Upgrade started, waiting for upgrade to complete...")
+    timings.phase(phase_key, "wait for upgraded")
+    try:
+        if canary is not None:
+            service = canary.promote(service, phase_key)
+        else:
+            service = client.wait(
+                environment,
+                service,
+                "upgraded",
+                options["upgrade_timeout"],
+                "A timeout occured while waiting for Rancher to complete the upgrade",
+                check=check,
+                **wait_options,
+            )
+    except DeployError as e:
+        # a canary upgrade is always rolled back if it fails, that's the point of it, even if it failed to be
+        # paused or continued, which would leave it paused with only some containers upgraded
+        if canary is None and not (options["rollback_on_error"] and isinstance(e, (WaitTimeout, ContainerFailed))):
+            raise
+
+        log.error(str(e))
+        log.warn("Processing image rollback...")
+        timings.phase(phase_key, "rollback")
+
+        client.rollback(environment, service)
+        client.wait(
+            environment,
+            service,
+            "active",
+            options["upgrade_timeout"],
+            "A timeout occured while waiting for Rancher to rollback the upgrade to its latest running state",
+            **wait_options,
+        )
+
+        raise RolledBack("Service sucessfully rolled back")
+
+    if canary is None and containers:
+        # canary upgrades are paused between their stages, only the others tell how long a batch takes
+        remember_batches(client, environment, service, containers, options, time.monotonic() - started)
+
+    if not options["finish_upgrade"]:
+        log.msg("Service upgraded")
+        return "upgraded"
+
+    log.msg("Finishing upgrade...")
+    timings.phase(phase_key, "finish upgrade")
+    client.finish_upgrade(environment, service)
+    client.wait(
+        environment,
+        service,
+        "active",
+        options["upgrade_timeout"],
+        "A timeout occured while waiting for Rancher to finish the previous upgrade",
+        **wait_options,
+    )
+
+    log.msg("Upgrade finished")
+    return "finished"
+
+
+async def upgrade_service_async(client, environment, stack, service, new_image, options, log=None):
+    """upgrade_service for an AsyncRancherClient, running in the client's thread pool"""
+    return await client.run(upgrade_service, client.client, environment, stack, service, new_image, options, log)
+
+
+def build_service(stack, name, new_image, options):
+    """Returns the service to create in the stack with --new-image"""
+    new_service = {
+        "name": name.lower(),
+        "stackId": stack["id"],
+        "startOnCreate": True,
+        "launchConfig": {
+            "imageUuid": ("docker:%s" % new_image),
+            "labels": options["labels"],
+            "environment": options["environment"],
+            "secrets": options["secrets"],
+        },
+    }
+
+    if options["host_id"] is not None:
+        new_service["launchConfig"]["requestedHostId"] = options["host_id"]
+
+    return new_service
+
+
+def create_service(client, environment, stack, name, new_image, options, log):
+    """Creates the service in the stack with --new-image, and sets its service links"""
+    new_service = build_service(stack, name, new_image, options)
+
+    if options["host_id"] is not None:
+        log.msg("Scheduled host %s" % options["host_id"])
+
+    log.msg("Creating service %s in environment %s with image %s..." % (new_service["name"], environment["name"], new_image))
+    service = client.create_service(environment, new_service)
+
+    service = link_service(client, environment, stack, service, options, log)
+
+    log.msg("Creation finished")
+    return service
+
+
+def service_links(options):
+    """The (link name, service name) pairs of --service-links and --service-link"""
+    links = []
+    if options["service_links"] is not None:
+        links += [tuple(item.split("=", 1)) for item in options["service_links"].split(",")]
+    return links + [tuple(item) for item in options["service_link"]]
+
+
+def link_service(client, environment, stack, service, options, log):
+    """Sets the --service-links and --service-link of a created service, to the services of the stack"""
+    links = service_links(options)
+    if not links:
+        return service
+
+    # one listing of the stack, instead of a scan of it for each link
+    ids = dict((s["name"].lower(), s["id"]) for s in client.list_services(environment, stack))
+    defined_service_links = [
+        {"name": link, "serviceId": ids[reference.lower()]} for link, reference in links if reference.lower() in ids
+    ]
+
+    if defined_service_links:
+        log.msg("Setting service links for service %s in environment %s..." % (service["name"], environment["name"]))
+        service = client.set_service_links(service, defined_service_links)
+        log.msg("Service links set")
+
+    return service
+
+
+def link_created(client, environment, targets, results, options, parallel, log):
+    """Sets the service links of the services created by a deploy of several targets, once they all exist
+
+    The services are created without their links, as a link to another service being created would be
+    missing otherwise.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def link(item):
+        target, result = item
+        target_log = log.for_target("[%s] " % result["target"])
+        try:
+            stack = client.find_stack(environment, target["stack"])
+            service = client.find_service(environment, stack, target["service"])
+            link_service(client, environment, stack, service, options, target_log)
+        except DeployError as e:
+            target_log.error(str(e))
+            result["status"], result["message"] = "failed", "Unable to set the service links: %s" % e
+
+    created = [(target, result) for target, result in zip(targets, results) if result["status"] == "created"]
+    if not service_links(options) or not created:
+        return
+
+    with ThreadPoolExecutor(max_workers=max(parallel, 1)) as pool:
+        list(pool.map(link, created))
+
+
+def build_upgrade(service, new_image, options):
+    """Returns the payload of the upgrade action, with the inServiceStrategy built from the running service"""
+    upgrade = {
+        "inServiceStrategy": {
+            "batchSize": options["batch_size"],
+            "intervalMillis": options["batch_interval"] * 1000,  # rancher expects miliseconds
+            "startFirst": options["start_before_stopping"],
+            "launchConfig": {},
+            "secondaryLaunchConfigs": [],
+        }
+    }
+    # copy over the existing config (a copy, so it can be compared with the running one)
+    upgrade["inServiceStrategy"]["launchConfig"] = copy.deepcopy(service["launchConfig"])
+
+    if options["labels"]:
+        upgrade["inServiceStrategy"]["launchConfig"]["labels"] = options["labels"]
+
+    if options["environment"]:
+        upgrade["inServiceStrategy"]["launchConfig"]["environment"] = options["environment"]
+
+    new_sidekick_image = options["new_sidekick_image"]
+
+    # new_sidekick_image parameter needs secondaryLaunchConfigs loaded
+    if options["sidekicks"] or new_sidekick_image:
+        # copy over existing sidekicks config
+        upgrade["inServiceStrategy"]["secondaryLaunchConfigs"] = copy.deepcopy(service["secondaryLaunchConfigs"])
+
+    if new_image:
+        # place new image into config
+        upgrade["inServiceStrategy"]["launchConfig"]["imageUuid"] = "docker:%s" % new_image
+
+    if new_sidekick_image:
+        for idx, secondaryLaunchConfigs in enumerate(service["secondaryLaunchConfigs"]):
+            if secondaryLaunchConfigs["name"] in new_sidekick_image:
+                upgrade["inServiceStrategy"]["secondaryLaunchConfigs"][idx]["imageUuid"] = (
+                    "docker:%s" % new_sidekick_image[secondaryLaunchConfigs["name"]]
+                )
+
+    return upgrade
+
+
+def config_changes(service, upgrade):
+    """Lists the differences between the running launch configs of the service and the ones in the upgrade"""
+    changes = []
+
+    def compare(name, running, wanted):
+        for key in sorted(set(running) | set(wanted)):
+            if running.get(key) != wanted.get(key):
+                changes.append("%s.%s: %s -> %s" % (name, key, running.get(key), wanted.get(key)))
+
+    compare("launchConfig", service["launchConfig"], upgrade["inServiceStrategy"]["launchConfig"])
+
+    # sidekicks are only part of the upgrade with --sidekicks or --new-sidekick-image
+    running = dict((config["name"], config) for config in service.get("secondaryLaunchConfigs") or [])
+    for config in upgrade["inServiceStrategy"]["secondaryLaunchConfigs"]:
+        compare("secondaryLaunchConfigs[%s]" % config["name"], running.get(config["name"], {}), config)
+
+    return changes
+
+
+def new_images(service, upgrade):
+    """Lists the images of the upgrade that the service isn't running yet"""
+    strategy = upgrade["inServiceStrategy"]
+    running = [service["launchConfig"]] + (service.get("secondaryLaunchConfigs") or [])
+    running_images = set(config.get("imageUuid") for config in running)
+
+    images = []
+    for config in [strategy["launchConfig"]] + strategy["secondaryLaunchConfigs"]:
+        image = config.get("imageUuid")
+        if image and image not in running_images and image[len("docker:") :] not in images:
+            images.append(image[len("docker:") :])
+    return images
+
+
+def pre_pull(client, environment, service, upgrade, options, log):
+    """Pulls the new images on the hosts before the upgrade starts, on all of them at the same time
+
+    Rancher pulls the image when it starts each batch of containers, so a rollout otherwise waits for
+    the pull once per batch. Pulls that fail or time out are only warned about, as the upgrade pulls
+    the images again anyway.
+    """
+    images = new_images(service, upgrade)
+    if not images:
+        return
+
+    log.msg("Pulling %s on the hosts..." % ", ".join(images))
+    tasks = [client.pull_image(environment, image) for image in images]
+    deadline = time.monotonic() + options["upgrade_timeout"]
+
+    while True:
+        tasks = [client.get_pull_task(environment, task) for task in tasks]
+        client.timings.count("polls")
+
+        pending = [task["image"] for task in tasks if task["state"] not in ("active", "error", "removed")]
+        if not pending:
+            break
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            log.warn("%s still being pulled, starting the upgrade anyway" % ", ".join(pending))
+            return
+
+        time.sleep(min(options["poll_interval"], remaining))
+
+    pulled = True
+    for task in tasks:
+        # the status of the pull on each host, by host id
+        failed = sorted(host for host, status in (task.get("status") or {}).items() if status.lower() != "done")
+        if task["state"] != "active" or failed:
+            log.warn("Unable to pull %s on every host (%s)" % (task["image"], ", ".join(failed) or task["state"]))
+            pulled = False
+
+    if pulled:
+        log.msg("Images pulled")
+
+
+def container_problem(instance, max_restarts):
+    """Says what's wrong with a container, or returns None if nothing is"""
+    if instance["state"] == "error":
+        return "is in error: %s" % (instance.get("transitioningMessage") or "no details")
+    if instance.get("healthState") == "unhealthy":
+        return "is unhealthy"
+    if (instance.get("startCount") or 0) > max_restarts + 1:
+        return "restarted %d times" % (instance["startCount"] - 1)
+    return None
+
+
+def container_check(client, environment, service, options, log):
+    """Returns a check for RancherClient.wait that follows the containers created by the upgrade
+
+    It logs how many of the new containers are up, and raises ContainerFailed as soon as one of them
+    ends up in error, unhealthy, or restarted more than max_restarts times, instead of waiting for
+    the upgrade timeout.
+    """
+    previous = set(instance["id"] for instance in client.list_instances(environment, service))
+
+    # global services don't have a scale, they run a container on every host
+    total = service.get("scale") or len(previous)
+    reported = [None]
+
+    def check(service):
+        new = [instance for instance in client.list_instances(environment, service) if instance["id"] not in previous]
+
+        for instance in new:
+            problem = container_problem(instance, options["max_restarts"])
+            if problem:
+                raise ContainerFailed("The new container %s %s" % (instance.get("name") or instance["id"], problem))
+
+        up = len([i for i in new if i["state"] == "running" and i.get("healthState") in (None, "healthy")])
+        if up != reported[0]:
+            reported[0] = up
+            log.msg("%d/%d containers upgraded" % (min(up, total), total))
+
+    return check
@@ -0,0 +1,90 @@
+import base64
+import json
+import threading
+import time
+
+
+class ServiceEvents(object):
+    """Follows Rancher's resource.change event stream and keeps the last known state of each service"""
+
+    def __init__(self, api, environment_id, auth, ssl_verify=True):
+        # http://rancher/v1 -> ws://rancher/v1 and https -> wss
+        self.url = "ws%s/projects/%s/subscribe?eventNames=resource.change" % (api[len("http") :], environment_id)
+        self.auth = auth
+        self.ssl_verify = ssl_verify
+        self.services = {}
+        self.closed = False
+        self.condition = threading.Condition()
+        self.socket = None
+
+    def connect(self, timeout=10):
+        """Opens the websocket and starts reading events in the background"""
+        # imported here, as it's slow to import and only --events needs it
+        try:
+            import ssl
+
+            import websocket
+        except ImportError:
+            raise RuntimeError("the websocket-client package isn't installed")
+
+        credentials = base64.b64encode(("%s:%s" % self.auth).encode("utf-8")).decode("ascii")
+        sslopt = {} if self.ssl_verify else {"cert_reqs": ssl.CERT_NONE}
+
+        self.socket = websocket.create_connection(
+            self.url, header=["Authorization: Basic %s" % credentials], timeout=timeout, sslopt=sslopt
+        )
+        self.socket.settimeout(None)
+
+        thread = threading.Thread(target=self._read)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+
+    def wait(self, service_id, state, timeout):
+        """Blocks until an event shows the service in the given state
+
+        Returns the service, or None if the timeout elapsed or the event stream was closed.
+        """
+        deadline = time.monotonic() + timeout
+
+        with self.condition:
+            while not self.closed:
+                service = self.services.get(service_id)
+                if service is not None and service.get("state") == state:
+                    return service
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+
+                self.condition.wait(remaining)
+
+        return None
+
+    def _read(self):
+        import websocket
+
+        try:
+            while True:
+                message = self.socket.recv()
+                if not message:
+                    break
+
+                event = json.loads(message)
+                if event.get("name") != "resource.change" or event.get("resourceType") != "service":
+                    continue
+
+                resource = (event.get("data") or {}).get("resource")
+                if resource:
+                    with self.condition:
+                        self.services[event["resourceId"]] = resource
+                        self.condition.notify_all()
+        except (websocket.WebSocketException, OSError, ValueError):
+            pass
+        finally:
+            with self.condition:
+                self.closed = True
+                self.condition.notify_all()
@@ -0,0 +1,116 @@
+import threading
+import time
+
+# services in these states are stopped or being deleted, a fleet rollout leaves them alone
+IGNORED_STATES = ("inactive", "deactivating", "removing", "removed", "purging", "purged")
+
+
+def parse_selector(value):
+    """Splits a --select value of the form key=value, key!=value or key"""
+    if "!=" in value:
+        key, _, expected = value.partition("!=")
+        return key, "!=", expected
+    if "=" in value:
+        key, _, expected = value.partition("=")
+        return key, "=", expected
+    return value, "exists", None
+
+
+def image_repository(image):
+    """Returns the repository of an image, without the docker: prefix, the :tag or the @digest"""
+    if image.startswith("docker:"):
+        image = image[len("docker:") :]
+
+    image = image.split("@", 1)[0]
+    name, _, tag = image.rpartition(":")
+    # a colon followed by a slash is the port of the registry, not a tag
+    if name and "/" not in tag:
+        return name
+    return image
+
+
+def matches_labels(labels, selectors):
+    for key, operator, expected in selectors:
+        if operator == "exists" and key not in labels:
+            return False
+        if operator == "=" and labels.get(key) != expected:
+            return False
+        if operator == "!=" and labels.get(key) == expected:
+            return False
+    return True
+
+
+def discover(client, environment, selectors, repositories, new_image):
+    """Returns a target for every service in the environment matching the label selectors and image repositories
+
+    With repositories, only the images of the service (or of its sidekicks) that are in one of them are
+    replaced by new_image. Without, the image of the service is. Services are found with one listing of
+    the environment, and the targets carry them so they aren't looked up again.
+    """
+    stacks = dict((stack["id"], stack) for stack in client.list_stacks(environment))
+    targets = []
+
+    for service in client.list_environment_services(environment):
+        if service.get("state") in IGNORED_STATES or service.get("stackId") not in stacks:
+            continue
+
+        launch_config = service.get("launchConfig") or {}
+        if not matches_labels(launch_config.get("labels") or {}, selectors):
+            continue
+
+        image = new_image
+        sidekick_images = {}
+
+        if repositories:
+            if image_repository(launch_config.get("imageUuid") or "") not in repositories:
+                image = None
+
+            for sidekick in service.get("secondaryLaunchConfigs") or []:
+                if image_repository(sidekick.get("imageUuid") or "") in repositories:
+                    sidekick_images[sidekick["name"]] = new_image
+
+            if image is None and not sidekick_images:
+                continue
+
+        stack = stacks[service["stackId"]]
+        targets.append(
+            {
+                "stack": stack["name"],
+                "service": service["name"],
+                "image": image,
+                "labels": {},
+                "variables": {},
+                "sidekick_images": sidekick_images,
+                "depends_on": [],
+                "environment": environment,
+                "found": (stack, service),
+            }
+        )
+
+    return targets
+
+
+def interleave(lists):
+    """Takes one item of each list in turn, so the environments of a rollout are upgraded side by side"""
+    interleaved = []
+    for position in range(max([len(items) for items in lists] or [0])):
+        interleaved += [items[position] for items in lists if position < len(items)]
+    return interleaved
+
+
+class RateLimit(object):
+    """Spaces out the calls to wait(), so there are at most per_minute of them in a minute"""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute else 0
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next)
+            self.next = start + self.interval
+
+        if start > now:
+            time.sleep(start - now)
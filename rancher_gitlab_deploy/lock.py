@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from rancher_gitlab_deploy.client import DeployError
+
+# how long a lease, or a place in the queue, is kept without being renewed (eg. if the job was killed)
+LEASE_TTL = 60
+
+# the key of the lease in the metadata of the service
+METADATA_KEY = "rancher-gitlab-deploy"
+
+
+class Lease(object):
+    """Makes concurrent deploys of the same service wait for each other, and skips the outdated ones
+
+    One deploy holds the lease while it upgrades the service, and the newest of the waiting ones (the one
+    with the highest order) is queued after it. An older deploy finding a newer one queued, or finding
+    that a newer one already succeeded, gives up: only the latest image gets rolled out. The state is a
+    dict with the holder, the queued deploy and the order of the latest successful deploy, which the
+    subclasses store somewhere all the deploys can see.
+    """
+
+    def __init__(self, order, image=None, owner=None):
+        self.order = order
+        self.image = image
+        self.owner = owner or "%s-%s" % (socket.gethostname(), os.urandom(4).hex())
+        self.renewing = None
+
+    def update(self, function):
+        """Calls function with the state, saves the state it changed, and returns what it returned"""
+        raise NotImplementedError
+
+    def entry(self):
+        return {"owner": self.owner, "order": self.order, "image": self.image, "expires": time.time() + LEASE_TTL}
+
+    def acquire(self, timeout, poll_interval, log):
+        """Waits for the lease, returns False if the deploy was superseded by a newer one instead"""
+        deadline = time.monotonic() + timeout
+        reported = None
+
+        while True:
+            result, holder = self.update(self.try_acquire)
+            if result is not None:
+                break
+
+            if holder["owner"] != reported:
+                reported = holder["owner"]
+                image = holder["image"] or "the sidekicks"
+                log.msg("Waiting for the deploy of %s by %s to finish..." % (image, holder["owner"]))
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeployError("A timeout occured while waiting for the deploy by %s to finish" % holder["owner"])
+
+            time.sleep(min(poll_interval, remaining, LEASE_TTL / 3.0))
+
+        if result:
+            self.renewing = threading.Event()
+            thread = threading.Thread(target=self.renew, args=(self.renewing,))
+            thread.daemon = True
+            thread.start()
+
+        return result
+
+    def try_acquire(self, state):
+        """Returns (True, None) if the lease was taken, (False, None) if superseded, or (None, holder) to wait"""
+        now = time.time()
+        for key in ("holder", "queued"):
+            if state.get(key) and state[key]["expires"] < now:
+                state[key] = None
+
+        holder, queued = state.get("holder"), state.get("queued")
+        if (state.get("latest") or 0) > self.order or (queued and queued["order"] > self.order):
+            return False, None
+
+        if holder is None or holder["owner"] == self.owner:
+            state["holder"] = self.entry()
+            if queued and queued["owner"] == self.owner:
+                state["queued"] = None
+            return True, None
+
+        # the place in the queue is only written again when it's about to expire, not on every poll
+        if not queued or queued["owner"] != self.owner or queued["expires"] < now + LEASE_TTL / 2.0:
+            state["queued"] = self.entry()
+        return None, holder
+
+    def renew(self, stop):
+        while not stop.wait(LEASE_TTL / 3.0):
+            try:
+                self.update(self.try_renew)
+            except Exception:
+                pass  # the next renewal may work, and the lease only expires after LEASE_TTL
+
+    def try_renew(self, state):
+        if (state.get("holder") or {}).get("owner") == self.owner:
+            state["holder"] = self.entry()
+
+    def release(self, succeeded):
+        """Gives the lease up, recording the order of the deploy if it succeeded"""
+        if self.renewing is not None:
+            self.renewing.set()
+
+        def release(state):
+            if (state.get("holder") or {}).get("owner") == self.owner:
+                state["holder"] = None
+            if succeeded:
+                state["latest"] = max(state.get("latest") or 0, self.order)
+
+        self.update(release)
+
+
+class FileLease(Lease):
+    """A lease in a file locked with flock, for the jobs of runners sharing a directory"""
+
+    def __init__(self, directory, key, order, image=None, owner=None):
+        super(FileLease, self).__init__(order, image, owner)
+        self.directory = directory
+        fingerprint = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(directory, "rancher-gitlab-deploy-%s.lock" % fingerprint)
+
+    def update(self, function):
+        import fcntl  # only on unix, like the runners sharing a directory
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or "{}")
+                except ValueError:
+                    state = {}
+
+                before = json.dumps(state, sort_keys=True)
+                result = function(state)
+
+                if json.dumps(state, sort_keys=True) != before:
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(state, f)
+                    f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+        return result
+
+
+class RancherLease(Lease):
+    """A lease in the metadata of the service in Rancher, for deploys that share nothing else
+
+    Rancher can't update a resource conditionally, so after changing the lease it's read back, and the
+    change is retried if another deploy overwrote it in the meantime.
+    """
+
+    def __init__(self, client, environment, service, order, image=None, owner=None):
+        super(RancherLease, self).__init__(order, image, owner)
+        self.client = client
+        self.environment = environment
+        self.service = service
+
+    def update(self, function):
+        while True:
+            metadata = self.client.get_service(self.environment, self.service).get("metadata") or {}
+            state = dict(metadata.get(METADATA_KEY) or {})
+
+            before = json.dumps(state, sort_keys=True)
+            result = function(state)
+            if json.dumps(state, sort_keys=True) == before:
+                return result
+
+            self.client.set_metadata(self.environment, self.service, dict(metadata, **{METADATA_KEY: state}))
+
+            # give a concurrent write the time to land, then check ours is the one that stuck
+            time.sleep(0.5)
+            metadata = self.client.get_service(self.environment, self.service).get("metadata") or {}
+            if (metadata.get(METADATA_KEY) or {}) == state:
+                return result
+
+
+def lease_for(client, environment, stack, service, new_image, options):
+    """Returns the lease of the --lock kind for the service, ordered by the lock_order option"""
+    order = options["lock_order"] or time.time()
+
+    if options["lock"] == "file":
+        key = "%s/%s/%s" % (environment["id"], stack["name"], service["name"])
+        return FileLease(options["lock_dir"] or tempfile.gettempdir(), key, order, new_image)
+
+    return RancherLease(client, environment, service, order, new_image)
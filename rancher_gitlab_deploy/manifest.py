@@ -0,0 +1,105 @@
+import json
+
+
+def load_manifest(path):
+    """Reads the services to deploy from a YAML or JSON manifest file
+
+    The manifest looks like this (the top level stack is used for entries without one):
+
+        stack: acme
+        services:
+          - service: migrate-worker
+            image: registry.example.com/acme/api:1.2
+          - service: api
+            image: registry.example.com/acme/api:1.2
+            labels: {traefik.enable: "true"}
+            variables: {LOG_LEVEL: info}
+            sidekick_images: {nginx: registry.example.com/acme/nginx:1.2}
+            depends_on: [migrate-worker]
+          - service: frontend
+            image: registry.example.com/acme/frontend:1.2
+            depends_on: [acme/api]
+
+    Returns a list of targets, in the order of the manifest. Raises ValueError if the manifest is invalid.
+    """
+    with open(path) as f:
+        text = f.read()
+
+    if path.endswith(".json"):
+        document = json.loads(text)
+    else:
+        # imported here, so deploys without a YAML manifest don't pay for it
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("Reading %s needs the PyYAML package, install it or use a .json manifest" % path)
+
+        try:
+            document = yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise ValueError("%s isn't valid YAML: %s" % (path, e))
+
+    if not isinstance(document, dict) or not isinstance(document.get("services"), list) or not document["services"]:
+        raise ValueError("The manifest %s should have a list of services" % path)
+
+    targets = []
+    for entry in document["services"]:
+        if not isinstance(entry, dict):
+            raise ValueError("Every service in the manifest should be a mapping: %r" % entry)
+
+        stack = entry.get("stack", document.get("stack"))
+        if not isinstance(stack, str) or not isinstance(entry.get("service"), str) or not stack or not entry["service"]:
+            raise ValueError("Every service in the manifest needs a service name and a stack: %r" % entry)
+
+        for key in ("labels", "variables", "sidekick_images"):
+            if not isinstance(entry.get(key) or {}, dict):
+                raise ValueError("The %s of %s/%s should be a mapping" % (key, stack, entry["service"]))
+
+        depends_on = entry.get("depends_on") or []
+        if not isinstance(depends_on, list) or not all(isinstance(name, str) for name in depends_on):
+            raise ValueError("The depends_on of %s/%s should be a list of service names" % (stack, entry["service"]))
+
+        targets.append(
+            {
+                "stack": stack,
+                "service": entry["service"],
+                "image": entry.get("image"),
+                "labels": dict(entry.get("labels") or {}),
+                "variables": dict(entry.get("variables") or {}),
+                "sidekick_images": dict(entry.get("sidekick_images") or {}),
+                # a dependency without a stack is in the same stack
+                "depends_on": [name if "/" in name else "%s/%s" % (stack, name) for name in depends_on],
+            }
+        )
+
+    check_dependencies(targets)
+    return targets
+
+
+def target_name(target):
+    return ("%s/%s" % (target["stack"], target["service"])).replace(".", "-").lower()
+
+
+def check_dependencies(targets):
+    """Makes sure every dependency is in the list of targets, and that they don't depend on each other in a loop"""
+    names = dict((target_name(target), target) for target in targets)
+
+    for target in targets:
+        for dependency in target["depends_on"]:
+            if dependency.replace(".", "-").lower() not in names:
+                raise ValueError("%s depends on %s, which isn't in the manifest" % (target_name(target), dependency))
+
+    done = set()
+
+    def visit(name, path):
+        if name in path:
+            raise ValueError("The services depend on each other in a loop: %s" % " -> ".join(path + [name]))
+        if name in done:
+            return
+
+        for dependency in names[name]["depends_on"]:
+            visit(dependency.replace(".", "-").lower(), path + [name])
+        done.add(name)
+
+    for name in names:
+        visit(name, [])
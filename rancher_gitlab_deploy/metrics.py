@@ -0,0 +1,118 @@
+import os
+
+import requests
+
+# upper bounds of the histogram buckets, in seconds
+PHASE_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+PREFIX = "rancher_gitlab_deploy_"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def labelled(name, labels):
+    if not labels:
+        return name
+    return "%s{%s}" % (name, ",".join('%s="%s"' % (key, escape(value)) for key, value in labels))
+
+
+class Metrics(object):
+    """Builds the Prometheus text format of the metrics of a deploy"""
+
+    def __init__(self):
+        self.lines = []
+
+    def family(self, name, kind, help):
+        self.lines.append("# HELP %s%s %s" % (PREFIX, name, help))
+        self.lines.append("# TYPE %s%s %s" % (PREFIX, name, kind))
+
+    def sample(self, name, value, labels=()):
+        self.lines.append("%s %s" % (labelled(PREFIX + name, labels), repr(float(value))))
+
+    def counter(self, name, help, values):
+        """values maps tuples of (label, value) pairs to the value of the counter with these labels"""
+        self.family(name, "counter", help)
+        for labels, value in sorted(values.items()):
+            self.sample(name, value, labels)
+
+    def histogram(self, name, help, buckets, observations):
+        """observations maps tuples of (label, value) pairs to the values observed with these labels"""
+        self.family(name, "histogram", help)
+        for labels, values in sorted(observations.items()):
+            for bound in buckets:
+                count = len([value for value in values if value <= bound])
+                self.sample(name + "_bucket", count, labels + (("le", repr(float(bound))),))
+            self.sample(name + "_bucket", len(values), labels + (("le", "+Inf"),))
+            self.sample(name + "_sum", sum(values), labels)
+            self.sample(name + "_count", len(values), labels)
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+def grouped(items, labels, value):
+    """Groups the value of the items by the labels, as a dict of (label, value) tuples to lists"""
+    groups = {}
+    for item in items:
+        key = tuple((label, item[label]) for label in labels)
+        groups.setdefault(key, []).append(value(item))
+    return groups
+
+
+def render(summary):
+    """Returns the metrics of a deploy in the Prometheus text format, from the summary of its Timings"""
+    metrics = Metrics()
+    requests_log = summary["requests"]["log"]
+
+    metrics.family("started_timestamp_seconds", "gauge", "When the deploy started")
+    metrics.sample("started_timestamp_seconds", summary["started_at"])
+    metrics.family("duration_seconds", "gauge", "How long the deploy took")
+    metrics.sample("duration_seconds", summary["seconds"])
+
+    statuses = grouped(summary["targets"], ["status"], lambda result: 1)
+    metrics.counter(
+        "services_total",
+        "Services deployed, by how far the deploy went (finished, unchanged, rolled back, failed...)",
+        dict((labels, len(values)) for labels, values in statuses.items()),
+    )
+    metrics.histogram(
+        "phase_duration_seconds",
+        "How long the phases of the upgrades took",
+        PHASE_BUCKETS,
+        grouped(summary["phases"], ["phase"], lambda phase: phase["seconds"]),
+    )
+    metrics.counter(
+        "polls_total", "Requests made to check the state of a service", {(): summary["counters"].get("polls", 0)}
+    )
+    metrics.histogram(
+        "api_request_duration_seconds",
+        "How long the requests to the Rancher API took, by method and status code",
+        REQUEST_BUCKETS,
+        grouped(requests_log, ["method", "status"], lambda request: request["seconds"]),
+    )
+    metrics.counter(
+        "api_retries_total", "Requests to the Rancher API retried after failing", {(): summary["requests"]["retries"]}
+    )
+    metrics.counter(
+        "api_received_bytes_total", "Bytes received from the Rancher API", {(): summary["requests"]["bytes_received"]}
+    )
+    metrics.counter("api_sent_bytes_total", "Bytes sent to the Rancher API", {(): summary["requests"]["bytes_sent"]})
+
+    return metrics.text()
+
+
+def write_metrics(path, summary):
+    """Writes the metrics to path, replacing it at once so a textfile collector never reads half of them"""
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(render(summary))
+    os.replace(tmp, path)
+
+
+def push_metrics(url, summary, timeout=10):
+    """Sends the metrics to a Prometheus Pushgateway, url being the group to push them to"""
+    r = requests.post(url, data=render(summary), headers={"Content-Type": "text/plain; version=0.0.4"}, timeout=timeout)
+    r.raise_for_status()
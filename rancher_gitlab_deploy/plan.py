@@ -0,0 +1,170 @@
+import difflib
+import json
+import time
+
+from rancher_gitlab_deploy.client import NAME_FIELDS
+from rancher_gitlab_deploy.client import SERVICE_FIELDS
+from rancher_gitlab_deploy.client import DeployError
+from rancher_gitlab_deploy.deploy import build_service
+from rancher_gitlab_deploy.deploy import build_upgrade
+from rancher_gitlab_deploy.deploy import display_name
+from rancher_gitlab_deploy.deploy import target_options
+from rancher_gitlab_deploy.timings import Timings
+
+
+class Snapshot(object):
+    """The stacks, services and secrets of some environments, to compute plans from without the Rancher API
+
+    It's a dict of environments, each with the lists of its stacks, services and secrets, that can be
+    saved to (and loaded from) a JSON file.
+    """
+
+    def __init__(self, url, environments, taken_at=None):
+        self.url = url
+        self.environments = environments
+        self.taken_at = taken_at or time.time()
+
+    @classmethod
+    def take(cls, client, environments):
+        """Lists the stacks, services and secrets of the environments, with one listing of each"""
+        taken = []
+        for environment in environments:
+            try:
+                secrets = [dict((key, s[key]) for key in NAME_FIELDS) for s in client.list_secrets(environment)]
+            except DeployError:
+                secrets = []  # older Rancher versions have no secrets
+
+            taken.append(
+                {
+                    "id": environment["id"],
+                    "name": environment["name"],
+                    "stacks": [dict((key, s[key]) for key in NAME_FIELDS) for s in client.list_stacks(environment)],
+                    "services": [
+                        dict((key, s[key]) for key in SERVICE_FIELDS if key in s)
+                        for s in client.list_environment_services(environment)
+                    ],
+                    "secrets": secrets,
+                }
+            )
+
+        return cls(client.host, taken)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            document = json.load(f)
+        return cls(document["url"], document["environments"], document["taken_at"])
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"url": self.url, "taken_at": self.taken_at, "environments": self.environments}, f)
+
+
+class SnapshotClient(object):
+    """Answers the lookups of a RancherClient from a snapshot, so a plan makes no request to Rancher"""
+
+    def __init__(self, snapshot, timings=None):
+        self.snapshot = snapshot
+        self.host = snapshot.url
+        self.cache = None
+        self.timings = timings or Timings()
+        self.environments = dict((environment["id"], environment) for environment in snapshot.environments)
+
+    def find_environment(self, name=None):
+        for environment in self.snapshot.environments:
+            if name is None or name.lower() in (environment["name"].lower(), environment["id"].lower()):
+                return {"id": environment["id"], "name": environment["name"]}
+
+        raise DeployError("The '%s' environment isn't in the snapshot" % (name or "default"))
+
+    def list_secrets(self, environment):
+        return self.environments[environment["id"]]["secrets"]
+
+    def find_secrets(self, environment, names):
+        secret_ids = dict((s["name"], s["id"]) for s in self.list_secrets(environment))
+
+        missing = [name for name in names if name not in secret_ids]
+        if missing:
+            raise DeployError("Cannot find secret(s) %s in environment %s ?!" % (", ".join(missing), environment["name"]))
+
+        return dict((name, secret_ids[name]) for name in names)
+
+    def list_stacks(self, environment):
+        return self.environments[environment["id"]]["stacks"]
+
+    def list_environment_services(self, environment):
+        return self.environments[environment["id"]]["services"]
+
+    def find_stack(self, environment, name):
+        for stack in self.list_stacks(environment):
+            if stack["name"].lower() == name.lower():
+                return stack
+        return None
+
+    def list_services(self, environment, stack):
+        return [s for s in self.list_environment_services(environment) if s["stackId"] == stack["id"]]
+
+    def find_service(self, environment, stack, name):
+        for service in self.list_services(environment, stack):
+            if service["name"].lower() == name.lower():
+                return service
+        return None
+
+    def get_service(self, environment, service):
+        for found in self.list_environment_services(environment):
+            if found["id"] == service["id"]:
+                return found
+        raise DeployError("Unable to request the service status from the Rancher API")
+
+
+def launch_configs(launch_config, secondary_launch_configs):
+    """The launch configs as indented JSON lines, to diff the running ones with the upgraded ones"""
+    document = {"launchConfig": launch_config, "secondaryLaunchConfigs": secondary_launch_configs}
+    return (json.dumps(document, indent=2, sort_keys=True) + "\n").splitlines(True)
+
+
+def plan_target(client, environment, target, options):
+    """Computes the request the upgrade of a target would make, without making it
+
+    Returns the same result as run_target, with the action (upgrade, create or unchanged), the payload
+    of the request and a unified diff of the launch configs.
+    """
+    environment = target.get("environment") or environment
+    name = display_name(target)
+    options = target_options(options, target)
+    result = {"target": name, "status": "failed", "seconds": 0.0, "message": "", "payload": None, "diff": ""}
+
+    if target.get("found"):
+        stack, service = target["found"]
+    else:
+        stack = client.find_stack(environment, target["stack"])
+        service = client.find_service(environment, stack, target["service"]) if stack else None
+
+    if service is None:
+        if not options["create"]:
+            missing = "service called '%s'" % target["service"] if stack else "stack called '%s'" % target["stack"]
+            result["message"] = "Unable to find a %s. Does it exist in the '%s' environment?" % (
+                missing,
+                environment["name"],
+            )
+            return result
+
+        stack = stack or {"id": None, "name": target["stack"].lower()}
+        payload = build_service(stack, target["service"], target["image"], options)
+        running = []
+        wanted = launch_configs(payload["launchConfig"], [])
+        result["status"] = "create"
+    else:
+        payload = build_upgrade(service, target["image"], options)
+        strategy = payload["inServiceStrategy"]
+        # only the sidekicks the upgrade sends are compared
+        sidekicks = dict((config["name"], config) for config in service.get("secondaryLaunchConfigs") or [])
+        running = launch_configs(
+            service["launchConfig"], [sidekicks.get(config["name"], {}) for config in strategy["secondaryLaunchConfigs"]]
+        )
+        wanted = launch_configs(strategy["launchConfig"], strategy["secondaryLaunchConfigs"])
+        result["status"] = "upgrade" if running != wanted else "unchanged"
+
+    result["payload"] = payload
+    result["diff"] = "".join(difflib.unified_diff(running, wanted, "%s (running)" % name, "%s (planned)" % name))
+    return result
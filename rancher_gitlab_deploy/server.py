@@ -0,0 +1,359 @@
+import hmac
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qsl
+from urllib.parse import urlsplit
+
+from rancher_gitlab_deploy.client import DeployError
+from rancher_gitlab_deploy.deploy import DEFAULT_OPTIONS
+from rancher_gitlab_deploy.deploy import Log
+from rancher_gitlab_deploy.deploy import new_target
+from rancher_gitlab_deploy.deploy import run_target
+
+# how many finished deploys are kept for their status to be polled
+MAX_DEPLOYS = 1000
+
+# the types of the options that are None by default, the others must have the type of their default
+OPTION_TYPES = {
+    "canary_probe_url": str,
+    "rollout_time": (int, float),
+    "lock": str,
+    "lock_dir": str,
+    "lock_order": (int, float),
+    "service_links": str,
+    "host_id": str,
+}
+
+
+class BadRequest(Exception):
+    """The deploy request can't be run, the message says why"""
+
+
+class JobLog(Log):
+    """Keeps the messages of a deploy for its status, and passes them on to the log of the agent"""
+
+    def __init__(self, job, log, prefix=""):
+        super(JobLog, self).__init__(prefix)
+        self.job = job
+        self.log = log
+
+    def for_target(self, prefix):
+        return JobLog(self.job, self.log.for_target("[%s] %s" % (self.job["id"], prefix)), prefix)
+
+    def msg(self, message):
+        self.job["log"].append(message)
+        self.log.msg(message)
+
+    def warn(self, message):
+        self.job["log"].append(message)
+        self.log.warn(message)
+
+    def error(self, message):
+        self.job["log"].append(message)
+        self.log.error(message)
+
+
+class DeployAgent(object):
+    """Runs the deploys it's sent, at most parallel at a time, with one client kept for all of them
+
+    The connections to Rancher, and the ids of the environments, stacks and services looked up (in the
+    cache of the client), are reused from one deploy to the next. Deploys of the same service run one
+    after the other, and a deploy still queued when a newer one of the same service arrives is skipped.
+    """
+
+    def __init__(self, client, environment, options, parallel, log):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.client = client
+        self.environment = environment
+        self.options = options
+        self.log = log
+        self.pool = ThreadPoolExecutor(max_workers=max(parallel, 1))
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        # the lock of each service, and the id of its latest deploy
+        self.services = {}
+        self.latest = {}
+
+    def submit(self, request):
+        """Queues a deploy, from a dict like the services of a --manifest, returns its job"""
+        target, options, environment = self.parse(request)
+        key = (environment or "", target["stack"].lower(), target["service"].lower())
+
+        with self.lock:
+            job = {
+                "id": str(next(self.ids)),
+                "target": "%s/%s" % (target["stack"], target["service"]),
+                "state": "queued",
+                "submitted_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "result": None,
+                "log": [],
+            }
+            self.jobs[job["id"]] = job
+            while len(self.jobs) > MAX_DEPLOYS and next(iter(self.jobs.values()))["state"] == "done":
+                self.jobs.popitem(last=False)
+
+            self.services.setdefault(key, threading.Lock())
+            self.latest[key] = job["id"]
+
+        self.pool.submit(self.run, job, key, target, options, environment)
+        return job
+
+    def parse(self, request):
+        if not isinstance(request, dict) or not all(isinstance(request.get(key), str) for key in ("stack", "service")):
+            raise BadRequest("A deploy needs a stack and a service")
+
+        for key in ("image", "environment"):
+            if request.get(key) is not None and not isinstance(request[key], str):
+                raise BadRequest("The %s must be a string" % key)
+        for key in ("labels", "variables", "sidekick_images", "options"):
+            if request.get(key) is not None and not isinstance(request[key], dict):
+                raise BadRequest("The %s must be an object" % key)
+        secrets = request.get("secrets")
+        if secrets is not None and not (isinstance(secrets, list) and all(isinstance(name, str) for name in secrets)):
+            raise BadRequest("The secrets must be a list of names")
+        if request.get("order") is not None and not is_number(request["order"]):
+            raise BadRequest("The order must be a number")
+
+        target = new_target(request["stack"].replace(".", "-"), request["service"].replace(".", "-"), request.get("image"))
+        target["labels"] = request.get("labels") or {}
+        target["variables"] = request.get("variables") or {}
+        target["sidekick_images"] = request.get("sidekick_images") or {}
+
+        overrides = request.get("options") or {}
+        unknown = set(overrides) - set(DEFAULT_OPTIONS)
+        if unknown:
+            raise BadRequest("Unknown option(s): %s" % ", ".join(sorted(unknown)))
+        if "secrets" in overrides:
+            raise BadRequest("The secrets are given by name in the secrets of the request, not as an option")
+
+        for key, value in overrides.items():
+            if not option_type_matches(key, value):
+                raise BadRequest("The %s option doesn't have the right type" % key)
+        for key in ("poll_interval", "poll_max_interval"):
+            # Rancher would be polled in a tight loop otherwise
+            if key in overrides and overrides[key] <= 0:
+                raise BadRequest("The %s option must be more than 0" % key)
+
+        options = dict(self.options, **overrides)
+        if request.get("order") is not None:
+            options["lock_order"] = request["order"]
+        if request.get("secrets"):
+            options["secrets"] = [{"type": "secretReference", "name": name} for name in request["secrets"]]
+
+        return target, options, request.get("environment")
+
+    def run(self, job, key, target, options, environment_name):
+        log = JobLog(job, self.log)
+        target_log = log.for_target("[%s] " % job["target"])
+        result = {"target": job["target"], "status": "failed", "seconds": 0.0, "message": ""}
+
+        try:
+            with self.services[key]:
+                job["started_at"] = time.time()
+
+                if self.latest[key] != job["id"]:
+                    target_log.msg("A newer deploy of the service was queued, skipping this one")
+                    result = dict(result, status="superseded")
+                else:
+                    job["state"] = "running"
+                    result = self.deploy(job, target, options, environment_name, log)
+        except Exception as e:
+            # the pool would drop the exception, and the deploy would look like it's running forever
+            result["message"] = "Unexpected error: %s: %s" % (type(e).__name__, e)
+            target_log.error(result["message"])
+        finally:
+            job["result"] = result
+            job["finished_at"] = time.time()
+            job["state"] = "done"
+
+    def deploy(self, job, target, options, environment_name, log):
+        try:
+            environment = self.environment
+            if environment_name:
+                environment = self.client.find_environment(environment_name)
+
+            # the secrets of the command line were looked up in the environment of the agent when it started, the
+            # ones of the request weren't, and secrets only exist in one environment
+            moved = environment["id"] != self.environment["id"]
+            if moved or any("secretId" not in secret for secret in options["secrets"]):
+                secret_ids = self.client.find_secrets(environment, [secret["name"] for secret in options["secrets"]])
+                options["secrets"] = [dict(secret, secretId=secret_ids[secret["name"]]) for secret in options["secrets"]]
+        except DeployError as e:
+            log.for_target("[%s] " % job["target"]).error(str(e))
+            return {"target": job["target"], "status": "failed", "seconds": 0.0, "message": str(e)}
+
+        return run_target(self.client, environment, target, options, log)
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job, log=list(job["log"])) if job is not None else None
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def option_type_matches(key, value):
+    """Whether an option of a request has the type of the option, numbers being ints or floats alike"""
+    default = DEFAULT_OPTIONS[key]
+    if key in OPTION_TYPES:
+        return value is None or (isinstance(value, OPTION_TYPES[key]) and not isinstance(value, bool))
+    if isinstance(default, bool):
+        return isinstance(value, bool)
+    if isinstance(default, (int, float)):
+        return is_number(value)
+    if isinstance(default, dict):
+        return isinstance(value, dict) and all(isinstance(item, str) for item in list(value) + list(value.values()))
+    if key == "service_link":
+        # pairs of the name of a service and the alias it's linked with
+        return isinstance(value, list) and all(
+            isinstance(link, list) and len(link) == 2 and all(isinstance(name, str) for name in link) for link in value
+        )
+    return isinstance(value, type(default))
+
+
+def gitlab_request(document, query):
+    """Turns a GitLab pipeline webhook into a deploy of its project, or returns None to ignore it
+
+    Like the defaults of --stack and --service in GitLab CI, the stack is the group of the project and
+    the service its name. The query string of the webhook URL can set the stack, service and image.
+    """
+    if document.get("object_kind") != "pipeline":
+        return None
+
+    attributes = document.get("object_attributes") or {}
+    if attributes.get("status") != "success":
+        return None
+
+    project = document.get("project") or {}
+    return {
+        "stack": query.get("stack") or project.get("namespace"),
+        "service": query.get("service") or project.get("name"),
+        "image": query.get("image"),
+        "environment": query.get("environment"),
+        "order": attributes.get("id"),
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+
+        parts = [part for part in urlsplit(self.path).path.split("/") if part]
+        if parts == ["health"]:
+            return self.respond(200, {"status": "ok"})
+
+        if len(parts) == 2 and parts[0] == "deploys":
+            job = self.server.agent.status(parts[1])
+            if job is None:
+                return self.respond(404, {"error": "No deploy with the id %s" % parts[1]})
+            return self.respond(200, job)
+
+        self.respond(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+
+        url = urlsplit(self.path)
+        if url.path.rstrip("/") != "/deploys":
+            return self.respond(404, {"error": "Not found"})
+
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            return self.respond(400, {"error": "The Content-Length isn't a number"})
+
+        try:
+            document = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self.respond(400, {"error": "The body isn't valid JSON"})
+
+        if not isinstance(document, dict):
+            return self.respond(400, {"error": "The body must be a JSON object"})
+
+        request = document
+        if self.headers.get("X-Gitlab-Event"):
+            request = gitlab_request(document, dict(parse_qsl(url.query)))
+            if request is None:
+                return self.respond(200, {"ignored": "Only the successful pipelines are deployed"})
+
+        try:
+            job = self.server.agent.submit(request)
+        except BadRequest as e:
+            return self.respond(400, {"error": str(e)})
+
+        self.respond(202, {"id": job["id"], "status_url": "/deploys/%s" % job["id"]})
+
+    def authorized(self):
+        """Checks the token, given as a bearer token or as the secret token of a GitLab webhook"""
+        token = self.server.token
+        if not token:
+            return True
+
+        given = self.headers.get("X-Gitlab-Token") or ""
+        authorization = self.headers.get("Authorization") or ""
+        if authorization.startswith("Bearer "):
+            given = authorization[len("Bearer ") :]
+
+        if hmac.compare_digest(given.encode("utf-8"), token.encode("utf-8")):
+            return True
+
+        self.respond(401, {"error": "Missing or wrong token"})
+        return False
+
+    def respond(self, status, document):
+        data = json.dumps(document).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def stop(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def serve(agent, address, token=None):
+    """Serves the deploy requests on address (host:port) until interrupted, or terminated
+
+    The deploys already started are let to finish before returning.
+    """
+    import signal
+
+    signal.signal(signal.SIGTERM, stop)
+
+    host, _, port = address.rpartition(":")
+    server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), Handler)
+    server.daemon_threads = True
+    server.agent = agent
+    server.token = token
+
+    agent.log.msg("Waiting for deploy requests on http://%s:%d/deploys" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        agent.close()
@@ -0,0 +1,114 @@
+import codecs
+import json
+
+# how much of the response is read at a time
+CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = " \t\n\r"
+
+
+class CollectionStream(object):
+    """Parses a collection of the Rancher API while it's downloaded, yielding its resources one at a time
+
+    Only the resource being parsed is held in memory, and only its fields listed in fields (all of them
+    if fields is None) are kept, so listing thousands of services doesn't need the whole response, or
+    every link and action of every service, in memory at once. Once the resources have been read,
+    document has the other keys of the collection, like its pagination.
+    """
+
+    def __init__(self, chunks, fields=None):
+        self.chunks = iter(chunks)
+        self.fields = fields
+        self.decoder = json.JSONDecoder()
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.position = 0
+        self.finished = False
+        self.bytes_read = 0
+        self.document = {}
+
+    def __iter__(self):
+        self.expect("{")
+        if self.peek() == "}":
+            return
+
+        while True:
+            key = self.value()
+            self.expect(":")
+
+            if key == "data":
+                for resource in self.resources():
+                    yield resource
+            else:
+                self.document[key] = self.value()
+
+            if self.expect(",}") == "}":
+                return
+
+    def resources(self):
+        self.expect("[")
+        if self.peek() == "]":
+            self.position += 1
+            return
+
+        while True:
+            resource = self.value()
+            if self.fields is not None:
+                resource = dict((key, resource[key]) for key in self.fields if key in resource)
+            yield resource
+
+            if self.expect(",]") == "]":
+                return
+
+    def fill(self):
+        """Appends the next chunk of the response to the buffer, returns False at the end of it"""
+        if self.finished:
+            return False
+
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.finished = True
+            self.buffer = self.buffer[self.position :] + self.text.decode(b"", final=True)
+        else:
+            self.bytes_read += len(chunk)
+            self.buffer = self.buffer[self.position :] + self.text.decode(chunk)
+        self.position = 0
+        return True
+
+    def peek(self):
+        """Returns the next character that isn't whitespace, without consuming it"""
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                raise ValueError("The collection ends unexpectedly")
+
+    def expect(self, characters):
+        character = self.peek()
+        if character not in characters:
+            raise ValueError("Expected one of %r at %r in the collection" % (characters, character))
+        self.position += 1
+        return character
+
+    def value(self):
+        """Decodes the next JSON value, reading more of the response until it's complete"""
+        self.peek()
+        wanted = 0
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # a number at the very end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.finished:
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.finished:
+                    raise
+
+            # read at least as much again before trying, so a large value isn't parsed over and over
+            wanted = 2 * (len(self.buffer) - self.position)
+            while len(self.buffer) - self.position < wanted and self.fill():
+                pass
@@ -0,0 +1,117 @@
+import json
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+
+class Timings(object):
+    """Records how long each phase of a deploy takes, and every request made to the Rancher API"""
+
+    def __init__(self, max_entries=None):
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        # a resident --serve agent only keeps the latest phases and requests
+        self.phases = deque(maxlen=max_entries)
+        self.requests = deque(maxlen=max_entries)
+        self.counters = {}
+        self.current = {}
+        self.lock = threading.Lock()
+
+    def phase(self, target, name):
+        """Ends the phase the target is in, and starts the next one (unless name is None)"""
+        now = time.monotonic()
+
+        with self.lock:
+            previous = self.current.pop(target, None)
+            if previous is not None:
+                previous["seconds"] = now - self.started - previous["start"]
+                self.phases.append(previous)
+
+            if name is not None:
+                self.current[target] = {"target": target, "phase": name, "start": now - self.started}
+
+    def on_response(self, response, *args, **kwargs):
+        """requests response hook, recording the latency and size of every request"""
+        if kwargs.get("stream"):
+            return  # the body hasn't been read yet, whoever streams it records the request once it has
+
+        self.record(response, len(response.content), response.elapsed.total_seconds())
+
+    def record(self, response, bytes_received, seconds):
+        request = response.request
+        # the retries urllib3 made before this response, after failed connections or 502/503/504s
+        retries = getattr(response.raw, "retries", None)
+
+        with self.lock:
+            self.requests.append(
+                {
+                    "method": request.method,
+                    "path": urlsplit(request.url).path,
+                    "status": response.status_code,
+                    "seconds": seconds,
+                    "bytes_sent": len(request.body or b""),
+                    "bytes_received": bytes_received,
+                    "retries": len(retries.history) if retries is not None else 0,
+                }
+            )
+
+    def count(self, name, amount=1):
+        """Adds to one of the counters of the deploy, like the number of polls of the service state"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def summary(self, results):
+        for target in list(self.current):
+            self.phase(target, None)
+
+        return {
+            "started_at": self.started_at,
+            "seconds": time.monotonic() - self.started,
+            "targets": results,
+            "phases": list(self.phases),
+            "counters": dict(self.counters),
+            "requests": {
+                "count": len(self.requests),
+                "seconds": sum(request["seconds"] for request in self.requests),
+                "bytes_sent": sum(request["bytes_sent"] for request in self.requests),
+                "bytes_received": sum(request["bytes_received"] for request in self.requests),
+                "retries": sum(request["retries"] for request in self.requests),
+                "log": list(self.requests),
+            },
+        }
+
+    def write_json(self, path, results):
+        with open(path, "w") as f:
+            json.dump(self.summary(results), f, indent=2)
+
+    def write_junit(self, path, results, failed):
+        """Writes one test case per service, so GitLab can show the deploy in the merge request
+
+        Services with a status in failed are reported as failures.
+        """
+        from xml.etree import ElementTree
+
+        summary = self.summary(results)
+        suite = ElementTree.Element(
+            "testsuite",
+            name="rancher-gitlab-deploy",
+            tests=str(len(results)),
+            failures=str(len([result for result in results if result["status"] in failed])),
+            time="%.3f" % summary["seconds"],
+        )
+
+        for result in results:
+            # the service is the last part of the target, which is prefixed by the environment in a fleet rollout
+            classname, _, service = result["target"].rpartition("/")
+            case = ElementTree.SubElement(
+                suite, "testcase", classname=classname, name=service, time="%.3f" % result["seconds"]
+            )
+
+            phases = ["%s: %.3fs" % (p["phase"], p["seconds"]) for p in summary["phases"] if p["target"] == result["target"]]
+            ElementTree.SubElement(case, "system-out").text = "\n".join(phases)
+
+            if result["status"] in failed:
+                ElementTree.SubElement(case, "failure", message=result["message"], type=result["status"])
+
+        ElementTree.ElementTree(suite).write(path, encoding="utf-8", xml_declaration=True)
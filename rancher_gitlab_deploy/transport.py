@@ -0,0 +1,286 @@
+import datetime
+import gzip
+import io
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+
+# Rancher answers with these while it restarts, or while its load balancer can't reach it
+RETRY_STATUSES = (502, 503, 504)
+
+# what the values of variables and secrets are replaced with in recordings
+REDACTED = "<redacted>"
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a default (connect, read) timeout to every request"""
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+def request_path(url):
+    """The path and query of a request, what recordings are matched on whatever the Rancher URL"""
+    url = urlsplit(url)
+    return url.path + ("?" + url.query if url.query else "")
+
+
+def redact(document):
+    """Returns a JSON document of the Rancher API without the values of the variables and secrets it has
+
+    The launch configs of services (and their sidekicks, and containers) have their variables in an
+    environment dict, and secrets their value.
+    """
+    if isinstance(document, list):
+        return [redact(item) for item in document]
+    if not isinstance(document, dict):
+        return document
+
+    redacted = {}
+    for key, value in document.items():
+        if key == "environment" and isinstance(value, dict):
+            value = dict((name, REDACTED) for name in value)
+        elif key == "value" and document.get("type") == "secret":
+            value = REDACTED
+        else:
+            value = redact(value)
+        redacted[key] = value
+    return redacted
+
+
+class Recorder(object):
+    """Writes the requests made to the Rancher API, their responses and how long they took, to a gzipped file
+
+    The file has a JSON line for the recording, with the Rancher URL, then one for each request. The
+    headers and bodies of the requests aren't kept, so neither are the API keys, and the values of
+    the variables and secrets in the responses are replaced, see redact.
+    """
+
+    def __init__(self, path, url):
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        # without the user and password, if the URL has them
+        url = urlsplit(url)
+        self.write({"url": "%s://%s" % (url.scheme, url.netloc.rpartition("@")[2]), "at": time.time()})
+
+    def write(self, document):
+        with self.lock:
+            self.file.write(json.dumps(document, separators=(",", ":")) + "\n")
+
+    def exchange(self, request, started, seconds, response=None, error=None):
+        document = {
+            "t": round(started - self.started, 6),
+            "method": request.method,
+            "path": request_path(request.url),
+            "seconds": round(seconds, 6),
+        }
+        if error is not None:
+            document["error"] = str(error)
+        else:
+            document["status"] = response.status_code
+            document["type"] = response.headers.get("Content-Type")
+            document["body"] = response.content.decode("utf-8", "replace")
+            try:
+                document["body"] = json.dumps(redact(json.loads(document["body"])))
+            except ValueError:
+                pass  # not JSON, there's nothing to redact
+        self.write(document)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class RecordingAdapter(TimeoutHTTPAdapter):
+    """TimeoutHTTPAdapter that records every request it sends with a Recorder
+
+    Streamed responses are read whole before they're returned, to record them.
+    """
+
+    def __init__(self, recorder, **kwargs):
+        self.recorder = recorder
+        super(RecordingAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        started = time.monotonic()
+        try:
+            response = super(RecordingAdapter, self).send(request, **kwargs)
+            response.content  # reads the body, even of a streamed response
+        except requests.RequestException as e:
+            self.recorder.exchange(request, started, time.monotonic() - started, error=e)
+            raise
+
+        self.recorder.exchange(request, started, time.monotonic() - started, response)
+        return response
+
+
+def resource_path(path):
+    """The resource a request reads or acts on, eg. a service for its GETs and its upgrade action"""
+    return path.split("?", 1)[0].rstrip("/")
+
+
+class Replay(object):
+    """The responses of a Recorder file, to answer the same requests with after their latency times latency
+
+    A request gets a response recorded for the same method and path. Requests other than GETs get
+    theirs in the order they were recorded, and each one starts a new epoch of the resource it acts
+    on. GETs replay how the resource changed over time within its epoch: a GET gets the response
+    recorded as long after the start of the epoch as it's made after it in the replay, so polling
+    more or less often sees the same states of the services at the same times, but never the state
+    an action that hasn't been replayed yet led to.
+    """
+
+    def __init__(self, path, latency=1.0):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            # the lines are written as the responses arrive, not as the requests are sent
+            exchanges = sorted((json.loads(line) for line in f if line.strip()), key=lambda exchange: exchange["t"])
+
+        self.url = header["url"]
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.exchanges = {}
+        # when each epoch of each resource started in the recording
+        self.epochs = {}
+        for exchange in exchanges:
+            starts = self.epochs.setdefault(resource_path(exchange["path"]), [exchange["t"]])
+            if exchange["method"] not in ("GET", "HEAD"):
+                starts.append(exchange["t"])
+            exchange["epoch"] = len(starts) - 1
+            self.exchanges.setdefault((exchange["method"], exchange["path"]), []).append(exchange)
+
+        # the epoch each resource is in, and when it started in the replay
+        self.resources = {}
+        # the number of responses replayed for each method and path of an action
+        self.positions = {}
+        self.misses = 0
+
+    def next(self, method, path):
+        """Returns the recorded exchange to answer the request with, or None if there isn't one"""
+        key = (method, path)
+        exchanges = self.exchanges.get(key)
+        resource = resource_path(path)
+        now = time.monotonic()
+
+        with self.lock:
+            if not exchanges:
+                self.misses += 1
+                return None
+
+            epoch, started = self.resources.setdefault(resource, (0, now))
+
+            if method not in ("GET", "HEAD"):
+                index = self.positions.get(key, 0)
+                self.positions[key] = index + 1
+                self.resources[resource] = (epoch + 1, now)
+                return exchanges[min(index, len(exchanges) - 1)]
+
+        epochs = [exchange["epoch"] for exchange in exchanges if exchange["epoch"] <= epoch]
+        if not epochs:
+            return exchanges[0]
+        if max(epochs) < epoch:
+            # nothing was read in this epoch of the resource, the last state read before it is the closest
+            return [exchange for exchange in exchanges if exchange["epoch"] <= epoch][-1]
+
+        # a response recorded in the epoch is taken to have changed halfway since the one before it was read
+        at = self.epochs[resource][epoch] + now - started
+        found = None
+        for exchange in exchanges:
+            if exchange["epoch"] != epoch:
+                continue
+            if found is not None and (found["t"] + exchange["t"]) / 2 > at:
+                break
+            found = exchange
+        return found
+
+
+class ReplayAdapter(BaseAdapter):
+    """Transport adapter answering the requests from a Replay, instead of sending them to Rancher"""
+
+    def __init__(self, replay):
+        super(ReplayAdapter, self).__init__()
+        self.replay = replay
+
+    def send(self, request, **kwargs):
+        exchange = self.replay.next(request.method, request_path(request.url))
+        if exchange is None:
+            exchange = {"status": 404, "type": "application/json", "seconds": 0.0}
+            exchange["body"] = json.dumps({"type": "error", "status": 404, "message": "Not in the recording"})
+
+        time.sleep(exchange["seconds"] * self.replay.latency)
+        if "error" in exchange:
+            raise requests.ConnectionError(exchange["error"], request=request)
+
+        body = exchange["body"].encode("utf-8")
+        response = requests.Response()
+        response.status_code = exchange["status"]
+        response.headers = CaseInsensitiveDict({"Content-Type": exchange["type"] or "", "Content-Length": str(len(body))})
+        response.raw = io.BytesIO(body)
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.elapsed = datetime.timedelta(seconds=exchange["seconds"] * self.replay.latency)
+        return response
+
+    def close(self):
+        pass
+
+
+def retry_policy(retries):
+    """Retries failed connections for every request, and errors or 502/503/504s for GETs only
+
+    Actions like upgrade or finishupgrade are POSTs, which aren't safe to send twice.
+    """
+    kwargs = dict(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=RETRY_STATUSES,
+        raise_on_status=False,
+    )
+
+    try:
+        return Retry(allowed_methods=frozenset(["GET", "HEAD"]), **kwargs)
+    except TypeError:
+        return Retry(method_whitelist=frozenset(["GET", "HEAD"]), **kwargs)  # urllib3 < 1.26
+
+
+def new_session(
+    auth, ssl_verify=True, connect_timeout=10, read_timeout=60, retries=3, pool_size=1, recorder=None, replay=None
+):
+    """Creates the requests session used to talk to Rancher
+
+    With a recorder, its requests are recorded, and with a replay they're answered from a recording.
+    """
+    session = requests.Session()
+    session.auth = auth
+    session.verify = ssl_verify
+
+    if replay is not None:
+        adapter = ReplayAdapter(replay)
+    else:
+        # keep one connection per concurrent upgrade alive, instead of reconnecting for each request
+        kwargs = dict(
+            timeout=(connect_timeout, read_timeout),
+            max_retries=retry_policy(retries),
+            pool_maxsize=max(pool_size, 1),
+        )
+        adapter = RecordingAdapter(recorder, **kwargs) if recorder is not None else TimeoutHTTPAdapter(**kwargs)
+
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
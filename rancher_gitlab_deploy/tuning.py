@@ -0,0 +1,90 @@
+import math
+import statistics
+
+# how long a batch is assumed to take, until an upgrade of the service has been timed
+DEFAULT_BATCH_SECONDS = 30
+
+# how many timed upgrades of each service are remembered, and for how long
+HISTORY_SIZE = 10
+HISTORY_TTL = 90 * 24 * 60 * 60
+
+
+def rollout_seconds(containers, batch_size, batch_interval, batch_seconds):
+    """How long Rancher takes to upgrade the containers: each batch is started, then waited for the interval"""
+    batches = int(math.ceil(containers / float(batch_size)))
+    return batches * batch_seconds + (batches - 1) * batch_interval
+
+
+def choose_batches(containers, batch_seconds, rollout_time, min_healthy, batch_interval):
+    """Returns the (batch size, batch interval) that upgrade the containers within rollout_time seconds
+
+    Batches are kept as small as they can be, and never stop more containers than min_healthy percent
+    of them allows. The interval is only shortened if the largest batches allowed would still take too
+    long, in which case the quickest rollout allowed is returned, even if it's over rollout_time.
+    """
+    largest = max(1, int(math.floor(containers * (100 - min_healthy) / 100.0)))
+
+    for batch_size in range(1, min(largest, containers) + 1):
+        if rollout_seconds(containers, batch_size, batch_interval, batch_seconds) <= rollout_time:
+            return batch_size, batch_interval
+
+    batch_size = min(largest, containers)
+    batches = int(math.ceil(containers / float(batch_size)))
+    if batches == 1:
+        return batch_size, batch_interval
+
+    slack = (rollout_time - batches * batch_seconds) / float(batches - 1)
+    return batch_size, max(0, min(batch_interval, int(slack)))
+
+
+def history_key(environment, service):
+    return "batches", environment["id"], service["id"]
+
+
+def batch_seconds(client, environment, service):
+    """The median time a batch of the service took in its last upgrades, remembered in the lookup cache"""
+    history = client.cache.get(*history_key(environment, service)) if client.cache else None
+    if not history:
+        return DEFAULT_BATCH_SECONDS
+    return statistics.median(history)
+
+
+def remember_batches(client, environment, service, containers, options, seconds):
+    """Remembers how long a batch took, from how long the upgrade of the containers did"""
+    if not client.cache:
+        return
+
+    batches = int(math.ceil(containers / float(options["batch_size"])))
+    per_batch = max(0.0, (seconds - (batches - 1) * options["batch_interval"]) / batches)
+
+    key = history_key(environment, service)
+    history = (client.cache.get(*key) or []) + [round(per_batch, 3)]
+    client.cache.set(history[-HISTORY_SIZE:], *key, ttl=HISTORY_TTL)
+
+
+def tune_batches(client, environment, service, options, log):
+    """Returns the options with a --batch-size and --batch-interval that meet --rollout-time, and the container count
+
+    Global services have no scale, their containers are counted instead.
+    """
+    containers = service.get("scale") or len(client.list_instances(environment, service))
+    if not containers:
+        return options, containers
+
+    seconds = batch_seconds(client, environment, service)
+    batch_size, batch_interval = choose_batches(
+        containers, seconds, options["rollout_time"], options["min_healthy"], options["batch_interval"]
+    )
+    expected = rollout_seconds(containers, batch_size, batch_interval, seconds)
+
+    log.msg(
+        "Upgrading %d of %d containers at a time, %ds apart, in about %ds"
+        % (batch_size, containers, batch_interval, expected)
+    )
+    if expected > options["rollout_time"]:
+        log.warn(
+            "The upgrade will take longer than %ds, to keep %d%% of the containers running"
+            % (options["rollout_time"], options["min_healthy"])
+        )
+
+    return dict(options, batch_size=batch_size, batch_interval=batch_interval), containers
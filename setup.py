@@ -14,6 +14,10 @@ setup(
         "requests",
         "colorama",
     ],
+    extras_require={
+        "events": ["websocket-client"],
+        "manifest": ["PyYAML"],
+    },
     entry_points={
         "console_scripts": [
             "rancher-gitlab-deploy=rancher_gitlab_deploy.cli:main",